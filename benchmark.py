@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import faiss
+import numpy as np
+
+import dbutils
+import llmutils
+from dbutils import (
+    FAISS_SHARDS,
+    get_chunk_headline,
+    load_faiss,
+    make_id_selector,
+    query_faiss,
+    query_fts,
+    query_hybrid,
+)
+
+
+def build_evaluation_set(limit=200, seed=0):
+    sections = {}
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        for page_id, page_name, text in cursor.execute(
+            "SELECT chunks.page_id, pages.name, chunks.text "
+            "FROM chunks INNER JOIN pages ON chunks.page_id = pages.id "
+            "WHERE chunks.status = 200",
+            [],
+        ):
+            title = page_name.replace("_", " ")
+            headline = get_chunk_headline(text)
+            if not headline or headline == title:
+                continue
+            key = (page_id, f"{title}: {headline}")
+            sections.setdefault(key, set()).add(text)
+    keys = sorted(sections)
+    random.Random(seed).shuffle(keys)
+    return [
+        {"query": query, "relevant": sections[(page_id, query)]}
+        for page_id, query in keys[:limit]
+    ]
+
+
+def make_hashed_embedding(prompt, dimension=1024):
+    # Deterministic stand-in for prompts missing from the recording: the same
+    # prompt always maps to the same unit vector, so offline runs stay
+    # repeatable, but its similarities carry no meaning.
+    seed = int.from_bytes(hashlib.sha256(prompt.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).astype("float32").tolist()
+
+
+def make_canned_embedder(path, record):
+    embeddings = {}
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            embeddings = json.load(file)
+    hashed = set()
+
+    def embed_one(tip, document_or_query, model="bge-m3", task=None, keep_alive=None):
+        prompt = tip + document_or_query
+        if record and prompt not in embeddings:
+            event = llmutils.embed_one(
+                tip, document_or_query, model, task=task, keep_alive=keep_alive
+            )
+            if event["status"] == 200:
+                embeddings[prompt] = event["data"]
+            return event
+        embedding = embeddings.get(prompt)
+        if embedding is None:
+            if not hashed:
+                print("prompt missing from", path, "- using hashed embeddings")
+            hashed.add(prompt)
+            embedding = make_hashed_embedding(prompt)
+        return {"type": "embedding", "status": 200, "data": embedding}
+
+    def embed_multiple(
+        tip, documents_or_queries, model="bge-m3", task=None, keep_alive=None
+    ):
+        events = [
+            embed_one(tip, prompt, model, task, keep_alive)
+            for prompt in documents_or_queries
+        ]
+        status = max(event["status"] for event in events)
+        data = [event["data"] for event in events] if status == 200 else None
+        return {"type": "embeddings", "status": status, "data": data}
+
+    def save():
+        with open(path, "w") as file:
+            json.dump(embeddings, file)
+
+    return embed_one, embed_multiple, save
+
+
+def get_faiss_memory(index):
+    shards = (
+        FAISS_SHARDS[index]["shards"].values() if index in FAISS_SHARDS else [index]
+    )
+    return sum(faiss.serialize_index(shard).size for shard in shards)
+
+
+def evaluate(search, evaluation_set, k):
+    recalls = []
+    reciprocal_ranks = []
+    latencies = []
+    for example in evaluation_set:
+        start = time.perf_counter()
+        texts = search(example["query"], k)
+        latencies.append(time.perf_counter() - start)
+        hits = [
+            rank for rank, text in enumerate(texts, 1) if text in example["relevant"]
+        ]
+        recalls.append(len(hits) / min(len(example["relevant"]), k))
+        reciprocal_ranks.append(1 / hits[0] if hits else 0.0)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        f"recall@{k}": statistics.mean(recalls),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+    }
+
+
+def run_benchmark(limit=200, k=5, shard_size=None):
+    evaluation_set = build_evaluation_set(limit)
+    if len(evaluation_set) < 2:
+        print("not enough sections with headlines for an evaluation set")
+        return {}
+    start = time.perf_counter()
+    index = load_faiss(shard_size)
+    print("load_faiss", f"{time.perf_counter() - start:.2f}s")
+    print("index", index.ntotal, "vectors", get_faiss_memory(index), "bytes")
+    print("evaluation set", len(evaluation_set), "queries")
+    searches = {
+        "query_faiss": lambda query, k: query_faiss(index, query, k),
+        "query_faiss_diverse": lambda query, k: query_faiss(
+            index, query, k, diversify=True
+        ),
+        "query_fts": lambda query, k: query_fts(query, k),
+        "query_hybrid": lambda query, k: query_hybrid(index, query, k),
+    }
+    results = {}
+    for name, search in searches.items():
+        results[name] = evaluate(search, evaluation_set, k)
+        print(
+            name,
+            " ".join(f"{key}={value:.3f}" for key, value in results[name].items()),
+        )
+    return results
+
+
+def check_id_selectors(sizes=(1, 7, 8, 100, 1_000), seed=0):
+    # Searches a small index with selectors from make_id_selector and checks
+    # that only the selected ids come back, for bitmap and batch selectors.
+    random_state = random.Random(seed)
+    index = faiss.IndexIDMap(faiss.IndexFlatIP(8))
+    ids = np.arange(4_096, dtype="int64")
+    X = np.random.default_rng(seed).random((ids.size, 8), dtype="float32")
+    index.add_with_ids(X, ids)
+    for size in sizes:
+        for spread in [size * 2, ids.size]:
+            selected = sorted(random_state.sample(range(min(spread, ids.size)), size))
+            params = faiss.SearchParameters(sel=make_id_selector(selected))
+            _, I = index.search(X[:4], k=ids.size, params=params)
+            found = {int(id) for id in I.ravel() if id >= 0}
+            assert found == set(selected), (size, spread, sorted(found - set(selected)))
+    print("id selectors ok")
+
+
+def check_fts_reextract(term="schoenbein"):
+    # Re-extracts and deletes a page in a scratch database whose FTS triggers
+    # predate the fix, and checks that the migration runs, the FTS indexes stay
+    # intact and the search follows the changes.
+    with open("sql/model.sql", "r") as file:
+        schema = "".join(line for line in file if not line.startswith("drop table"))
+    for table, column in [("pages_fts", "name"), ("chunks_fts", "text")]:
+        schema = schema.replace(
+            f"insert into {table}({table}, rowid, {column})\n"
+            f"    values ('delete', old.id, old.{column});",
+            f"insert into {table}({table}, rowid)\n    values ('delete', old.id);",
+        )
+    html = (
+        "<html><body><h1>Ozone</h1><p>Ozone is a pale blue gas.</p>"
+        "<h2>History</h2><p>Schoenbein noticed the smell in 1839.</p></body></html>"
+    )
+    cwd = os.getcwd()
+    embed_multiple = dbutils.embed_multiple
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            os.chdir(directory)
+            os.mkdir("data")
+            _, dbutils.embed_multiple, _ = make_canned_embedder("missing.json", False)
+            with sqlite3.connect("data/rag.db") as connection:
+                connection.executescript(schema)
+                connection.execute(
+                    "INSERT INTO projects (name) VALUES ('en.wikipedia')"
+                )
+                connection.execute(
+                    "INSERT INTO pages (project_id, name, views, status, html) "
+                    "VALUES (1, 'Ozone', 1000, 200, ?)",
+                    [zlib.compress(html.encode("utf-8"))],
+                )
+                connection.commit()
+            index = dbutils.make_faiss_index()
+            for _ in range(2):
+                dbutils.reextract_wikipedia_page(index, "en.wikipedia", "Ozone")
+                assert len(query_fts(term)) == 1, query_fts(term)
+            dbutils.delete_wikipedia_page(index, "en.wikipedia", "Ozone")
+            assert query_fts(term) == [], query_fts(term)
+            with sqlite3.connect("data/rag.db") as connection:
+                assert not dbutils.migrate_fts_triggers(connection)
+                for table in ["pages_fts", "chunks_fts"]:
+                    connection.execute(
+                        f"INSERT INTO {table}({table}) VALUES ('integrity-check')"
+                    )
+        finally:
+            dbutils.embed_multiple = embed_multiple
+            os.chdir(cwd)
+    print("fts re-extract ok")
+
+
+STARTUP_MODULES = [
+    "llmutils",
+    "dbutils",
+    "retrievalutils",
+    "tools",
+    "retrieval_service",
+    "gradio_chat_app",
+    "gradio_chat_stream_app",
+    "gradio_viewer",
+]
+
+
+def measure_import_time(module):
+    # Every import is reported on stderr as
+    # "import time: self [us] | cumulative | imported package".
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    wall_seconds = time.perf_counter() - start
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if self_us.strip().isdigit():
+            imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return {
+        "returncode": result.returncode,
+        "wall_seconds": wall_seconds,
+        "import_seconds": imports.get(module, (0, 0))[1] / 1e6,
+        "imports": imports,
+    }
+
+
+def run_startup_benchmark(modules=STARTUP_MODULES, heavy=("numpy", "faiss", "gradio")):
+    results = {}
+    for module in modules:
+        results[module] = measure_import_time(module)
+        imports = (
+            results[module]["imports"] if not results[module]["returncode"] else {}
+        )
+        slowest = sorted(imports.items(), key=lambda item: item[1][0], reverse=True)
+        print(
+            module,
+            "failed" if results[module]["returncode"] else "",
+            f"import={results[module]['import_seconds']:.3f}s",
+            f"wall={results[module]['wall_seconds']:.3f}s",
+            "heavy=" + ",".join(name for name in heavy if name in imports),
+            "slowest="
+            + ",".join(
+                f"{name}:{self_us / 1000:.0f}ms" for name, (self_us, _) in slowest[:3]
+            ),
+        )
+    return results
+
+
+if __name__ == "__main__":
+    limit = int(sys.argv[2]) if len(sys.argv) >= 3 and sys.argv[2].isdigit() else 200
+    if len(sys.argv) >= 2 and sys.argv[1] in ["offline", "record"]:
+        embed_one, embed_multiple, save = make_canned_embedder(
+            "data/benchmark_embeddings.json", sys.argv[1] == "record"
+        )
+        dbutils.embed_one = embed_one
+        dbutils.embed_multiple = embed_multiple
+        run_benchmark(limit)
+        if sys.argv[1] == "record":
+            save()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "selectors":
+        check_id_selectors()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "fts":
+        check_fts_reextract()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "startup":
+        run_startup_benchmark(sys.argv[2:] or STARTUP_MODULES)
+    else:
+        run_benchmark(limit)
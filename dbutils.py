@@ -1,13 +1,137 @@
 import bz2
+from collections import OrderedDict
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import importlib
+import inspect
 from itertools import batched
 import json
+import os
+import queue
 import sqlite3
+import threading
+import time
+import urllib.parse
+import weakref
 import zlib
-import numpy as np
 from httputils import WikipediaHTMLParser, get_wikipedia_page
 from llmutils import embed_one, embed_multiple
-from ftsutils import sanitize_fts_query
-import faiss
+from ftsutils import (
+    sanitize_fts_query,
+    normalize_title,
+    trigram_fts_query,
+    configure_fts,
+    optimize_fts,
+    report_fts,
+)
+
+
+class LazyModule:
+    # Imports the module on first use, so the SQLite-only functions of this
+    # module neither wait for nor need numpy and faiss.
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+np = LazyModule("numpy")
+faiss = LazyModule("faiss")
+
+FAISS_TOMBSTONES = weakref.WeakKeyDictionary()
+FAISS_SHARDS = weakref.WeakKeyDictionary()
+FAISS_MAX_IDS = weakref.WeakKeyDictionary()
+TITLE_PREFIX_LENGTH = 10
+FTS_TABLES = ["pages_fts", "pages_trigram", "chunks_fts"]
+# The embedding model is small, keeping it resident spares the chat model from
+# being swapped out for every retrieval.
+EMBEDDING_KEEP_ALIVE = "1h"
+
+
+class ResultCache:
+    def __init__(self, path, max_entries=1_024):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.version = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_version(self):
+        # PRAGMA data_version changes whenever another connection, in this or any
+        # other process, commits to the database.
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        (data_version,) = self.connection.execute("PRAGMA data_version").fetchone()
+        return data_version, self.generation
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def get(self, key, compute):
+        with self.lock:
+            version = self.get_version()
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                # Copies, so callers cannot change the cached results.
+                return copy.deepcopy(self.entries[key])
+            self.misses += 1
+        result = compute()
+        with self.lock:
+            if self.version == version:
+                self.entries[key] = result
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return copy.deepcopy(result)
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
+RESULT_CACHE = ResultCache("data/rag.db")
+
+
+def cache_results(function):
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def cached_function(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        # Keyed on the raw term, the wrapped functions normalize it in different
+        # ways (FTS query vs. title), so no normalization is safe for all.
+        key = (function.__name__, json.dumps(arguments.arguments, sort_keys=True))
+        return RESULT_CACHE.get(key, lambda: function(*args, **kwargs))
+
+    return cached_function
 
 
 def store_projects(connection, projects):
@@ -102,16 +226,25 @@ def load_page(connection, project_id, page_name):
     return rows[0][0] if rows else None
 
 
-def load_chunks(connection, page_id=None):
+def load_chunks(connection, page_id=None, min_id=0):
     chunk_ids = []
     embeddings = []
     cursor = connection.cursor()
-    if not page_id:
-        cursor.execute("SELECT id, embedding FROM chunks WHERE status = 200", [])
+    if page_id is None:
+        cursor.execute(
+            "SELECT id, embedding FROM chunks WHERE id > ? AND status = 200",
+            [min_id],
+        )
+    elif isinstance(page_id, list):
+        cursor.execute(
+            "SELECT id, embedding FROM chunks "
+            "WHERE page_id IN (SELECT value FROM json_each(?)) AND id > ? AND status = 200",
+            [json.dumps(page_id), min_id],
+        )
     else:
         cursor.execute(
-            "SELECT id, embedding FROM chunks WHERE page_id = ? AND status = 200",
-            [page_id],
+            "SELECT id, embedding FROM chunks WHERE page_id = ? AND id > ? AND status = 200",
+            [page_id, min_id],
         )
     for chunk_id, embedding in cursor:
         chunk_ids.append(chunk_id)
@@ -149,47 +282,567 @@ def load_wikipedia_pageviews(path):
             store_pages(connection, projects, batch)
 
 
+def make_faiss_index():
+    # return faiss.IndexIDMap(faiss.IndexFlatIP(768))
+    return faiss.IndexIDMap(faiss.IndexFlatIP(1024))
+    # return faiss.IndexIDMap(faiss.IndexFlatIP(4096))
+
+
+def make_faiss_shards(shard_size):
+    index = faiss.IndexShards(make_faiss_index().d, True, False)
+    FAISS_SHARDS[index] = {"size": shard_size, "shards": {}, "mapped": {}}
+    return index
+
+
+def add_faiss_shard(index, number, shard, path=None):
+    shards = FAISS_SHARDS[index]
+    index.add_shard(shard)
+    shards["shards"][number] = shard
+    if path:
+        shards["mapped"][number] = path
+
+
+def get_faiss_shard(index, number):
+    shards = FAISS_SHARDS[index]
+    if number in shards["mapped"]:
+        # Memory mapped shards are read-only, so a shard that receives vectors
+        # is loaded into memory first.
+        path = shards["mapped"].pop(number)
+        index.remove_shard(shards["shards"][number])
+        add_faiss_shard(index, number, faiss.read_index(path))
+    elif number not in shards["shards"]:
+        add_faiss_shard(index, number, make_faiss_index())
+    return shards["shards"][number]
+
+
+def get_faiss_ids(index):
+    if index in FAISS_SHARDS:
+        return np.concatenate(
+            [np.empty(0, dtype="int64")]
+            + [
+                faiss.vector_to_array(shard.id_map)
+                for shard in FAISS_SHARDS[index]["shards"].values()
+            ]
+        )
+    return faiss.vector_to_array(index.id_map)
+
+
+def get_faiss_max_id(index):
+    if index not in FAISS_MAX_IDS:
+        if index in FAISS_SHARDS:
+            # Shards hold consecutive id ranges, so the largest id is in the
+            # last shard that is not empty.
+            shards = [
+                shard
+                for _, shard in sorted(FAISS_SHARDS[index]["shards"].items())
+                if shard.ntotal
+            ]
+            ids = faiss.vector_to_array(shards[-1].id_map) if shards else []
+        else:
+            ids = faiss.vector_to_array(index.id_map)
+        FAISS_MAX_IDS[index] = int(max(ids)) if len(ids) else 0
+    return FAISS_MAX_IDS[index]
+
+
+def add_faiss_vectors(index, X, I):
+    max_id = max(get_faiss_max_id(index), int(I.max()))
+    if index not in FAISS_SHARDS:
+        index.add_with_ids(X, I)
+    else:
+        numbers = I // FAISS_SHARDS[index]["size"]
+        for number in np.unique(numbers).tolist():
+            selected = numbers == number
+            get_faiss_shard(index, number).add_with_ids(X[selected], I[selected])
+        index.syncWithSubIndexes()
+    FAISS_MAX_IDS[index] = max_id
+
+
+def get_faiss_tombstones(index):
+    return FAISS_TOMBSTONES.setdefault(index, set())
+
+
+def exclude_faiss_tombstones(index, chunk_ids):
+    tombstones = FAISS_TOMBSTONES.get(index)
+    if not tombstones:
+        return chunk_ids
+    return np.setdiff1d(chunk_ids, np.fromiter(tombstones, dtype="int64"))
+
+
+def make_search_parameters(index):
+    tombstones = FAISS_TOMBSTONES.get(index)
+    if not tombstones:
+        return None
+    selector = make_id_selector(np.fromiter(tombstones, dtype="int64"))
+    return faiss.SearchParameters(sel=faiss.IDSelectorNot(selector))
+
+
 def update_faiss(connection, index, page_id=None):
-    chunk_ids, embeddings = load_chunks(connection, page_id)
+    # Chunk ids are AUTOINCREMENT and never reused, so the chunks missing from
+    # the index are the ones above its largest id.
+    chunk_ids, embeddings = load_chunks(connection, page_id, get_faiss_max_id(index))
     if chunk_ids and embeddings:
         X = np.vstack(embeddings)
         faiss.normalize_L2(X)
         I = np.array(chunk_ids, dtype="int64")
-        index.add_with_ids(X, I)
+        add_faiss_vectors(index, X, I)
         # test_query = X[0].reshape(1, -1)
         # test_D, test_I = index.search(test_query, 3)
     return index
 
 
-def load_faiss():
+def add_faiss_chunks(connection, index, chunk_ids):
+    embeddings = load_chunk_embeddings(connection.cursor(), chunk_ids)
+    if embeddings:
+        X = np.vstack(list(embeddings.values()))
+        faiss.normalize_L2(X)
+        add_faiss_vectors(index, X, np.array(list(embeddings), dtype="int64"))
+    return index
+
+
+def remove_faiss_ids(index, chunk_ids):
+    chunk_ids = np.ascontiguousarray(chunk_ids, dtype="int64")
+    if not chunk_ids.size:
+        return 0
+    selector = faiss.IDSelectorBatch(chunk_ids.size, faiss.swig_ptr(chunk_ids))
+    if index in FAISS_SHARDS:
+        shards = FAISS_SHARDS[index]
+        numbers = chunk_ids // shards["size"]
+        mapped = np.isin(numbers, list(shards["mapped"]))
+        get_faiss_tombstones(index).update(int(id) for id in chunk_ids[mapped])
+        removed = sum(
+            shard.remove_ids(selector)
+            for number, shard in shards["shards"].items()
+            if number not in shards["mapped"] and number in numbers
+        )
+        index.syncWithSubIndexes()
+        return removed
+    try:
+        return index.remove_ids(selector)
+    except RuntimeError:
+        # Graph based indexes (e.g. HNSW) cannot remove vectors, so the ids are
+        # masked out of every search until the next compaction.
+        get_faiss_tombstones(index).update(int(id) for id in chunk_ids)
+        return 0
+
+
+def reset_faiss(index):
+    if index in FAISS_SHARDS:
+        shards = FAISS_SHARDS[index]
+        for number in list(shards["mapped"]):
+            index.remove_shard(shards["shards"].pop(number))
+            del shards["mapped"][number]
+        index.syncWithSubIndexes()
+    index.reset()
+    FAISS_MAX_IDS.pop(index, None)
+
+
+def compact_faiss(connection, index):
+    tombstones = get_faiss_tombstones(index)
+    if index in FAISS_SHARDS:
+        # Only the shards holding tombstones are loaded into memory and have the
+        # ids removed, the others stay memory mapped.
+        shards = FAISS_SHARDS[index]
+        chunk_ids = np.fromiter(tombstones, dtype="int64")
+        numbers = chunk_ids // shards["size"]
+        for number in np.unique(numbers).tolist():
+            if number not in shards["shards"]:
+                continue
+            selected = np.ascontiguousarray(chunk_ids[numbers == number])
+            get_faiss_shard(index, number).remove_ids(
+                faiss.IDSelectorBatch(selected.size, faiss.swig_ptr(selected))
+            )
+        index.syncWithSubIndexes()
+        tombstones.clear()
+        return index
+    reset_faiss(index)
+    tombstones.clear()
+    return update_faiss(connection, index)
+
+
+def maybe_compact_faiss(connection, index, max_tombstone_ratio=0.1):
+    tombstones = FAISS_TOMBSTONES.get(index)
+    if tombstones and len(tombstones) > index.ntotal * max_tombstone_ratio:
+        compact_faiss(connection, index)
+    return index
+
+
+FTS_TRIGGERS_SQL = """
+drop trigger if exists pages_ad;
+drop trigger if exists pages_au;
+drop trigger if exists chunks_ad;
+drop trigger if exists chunks_au;
+
+create trigger pages_ad
+after delete on pages
+begin
+    insert into pages_fts(pages_fts, rowid, name)
+    values ('delete', old.id, old.name);
+end;
+
+create trigger pages_au
+after update of id, name on pages
+begin
+    insert into pages_fts(pages_fts, rowid, name)
+    values ('delete', old.id, old.name);
+    insert into pages_fts(rowid, name)
+    values (new.id, new.name);
+end;
+
+create trigger chunks_ad
+after delete on chunks
+begin
+    insert into chunks_fts(chunks_fts, rowid, text)
+    values ('delete', old.id, old.text);
+end;
+
+create trigger chunks_au
+after update of id, text on chunks
+begin
+    insert into chunks_fts(chunks_fts, rowid, text)
+    values ('delete', old.id, old.text);
+    insert into chunks_fts(rowid, text)
+    values (new.id, new.text);
+end;
+
+insert into pages_fts(pages_fts) values ('rebuild');
+insert into chunks_fts(chunks_fts) values ('rebuild');
+"""
+
+
+def migrate_fts_triggers(connection):
+    # Databases created from an older sql/model.sql have delete triggers that
+    # leave out the old values, which external content tables need to remove
+    # their terms. Their FTS indexes are rebuilt after the triggers are fixed.
+    if connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+        "AND name IN ('pages_ad', 'pages_au', 'chunks_ad', 'chunks_au') "
+        "AND sql LIKE '%values (''delete'', old.id);%'"
+    ).fetchone()[0]:
+        connection.executescript(FTS_TRIGGERS_SQL)
+        return True
+    return False
+
+
+def delete_page_chunks(connection, index, page_id):
+    cursor = connection.cursor()
+    chunk_ids = [
+        chunk_id
+        for (chunk_id,) in cursor.execute(
+            "SELECT id FROM chunks WHERE page_id = ?",
+            [page_id],
+        )
+    ]
+    cursor.execute("DELETE FROM chunks WHERE page_id = ?", [page_id])
+    remove_faiss_ids(index, chunk_ids)
+    return chunk_ids
+
+
+def check_faiss_consistency(connection, index):
+    tombstones = FAISS_TOMBSTONES.get(index, set())
+    faiss_ids = exclude_faiss_tombstones(index, get_faiss_ids(index))
+    faiss_ids, counts = np.unique(faiss_ids, return_counts=True)
+    cursor = connection.cursor()
+    chunk_ids = np.fromiter(
+        (
+            chunk_id
+            for (chunk_id,) in cursor.execute(
+                "SELECT id FROM chunks WHERE status = 200", []
+            )
+        ),
+        dtype="int64",
+    )
+    return {
+        "ntotal": int(index.ntotal),
+        "chunks": int(chunk_ids.size),
+        "tombstones": len(tombstones),
+        "duplicates": faiss_ids[counts > 1].tolist(),
+        "missing": np.setdiff1d(chunk_ids, faiss_ids).tolist(),
+        "stale": np.setdiff1d(faiss_ids, chunk_ids).tolist(),
+    }
+
+
+def save_faiss_shards(index, directory="data/faiss"):
+    if index not in FAISS_SHARDS:
+        raise ValueError("Only a sharded FAISS index can be saved")
+    if not directory:
+        raise ValueError("No directory to save the FAISS shards to")
+    os.makedirs(directory, exist_ok=True)
+    shards = FAISS_SHARDS[index]
+    for number, shard in shards["shards"].items():
+        if number not in shards["mapped"]:
+            faiss.write_index(
+                shard, os.path.join(directory, f"shard-{number:06d}.faiss")
+            )
+
+
+def load_faiss_shards(index, directory):
+    paths = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("shard-") and name.endswith(".faiss")
+    )
+    for position, path in enumerate(paths):
+        number = int(os.path.basename(path)[6:-6])
+        if position < len(paths) - 1:
+            # Completed id ranges are only searched, so they stay on disk and
+            # are paged in on demand; the last shard keeps receiving vectors.
+            shard = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC)
+            add_faiss_shard(index, number, shard, path)
+        else:
+            add_faiss_shard(index, number, faiss.read_index(path))
+    index.syncWithSubIndexes()
+    return index
+
+
+def load_faiss(shard_size=None, directory=None):
     with sqlite3.connect("data/rag.db") as connection:
-        # index = faiss.IndexIDMap(faiss.IndexFlatIP(768))
-        index = faiss.IndexIDMap(faiss.IndexFlatIP(1024))
-        # index = faiss.IndexIDMap(faiss.IndexFlatIP(4096))
+        if not shard_size:
+            return update_faiss(connection, make_faiss_index())
+        index = make_faiss_shards(shard_size)
+        if directory and os.path.isdir(directory):
+            load_faiss_shards(index, directory)
+            # Only the ids are compared, the embeddings of the chunks that are
+            # already in the mapped shards are never read.
+            consistency = check_faiss_consistency(connection, index)
+            remove_faiss_ids(index, consistency["stale"])
+            add_faiss_chunks(connection, index, consistency["missing"])
+            return index
         return update_faiss(connection, index)
 
 
-def query_faiss(index, prompt, k=5):
+def load_chunk_texts(cursor, chunk_ids):
+    return dict(
+        cursor.execute(
+            "SELECT id, text FROM chunks WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps(sorted({int(id) for id in chunk_ids if id >= 0}))],
+        )
+    )
+
+
+def load_chunk_embeddings(cursor, chunk_ids):
+    return {
+        chunk_id: np.frombuffer(embedding, dtype="float32")
+        for chunk_id, embedding in cursor.execute(
+            "SELECT id, embedding FROM chunks WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps(sorted({int(id) for id in chunk_ids}))],
+        )
+    }
+
+
+def select_faiss_chunk_ids(distances, ids, chunk_texts):
+    chunk_ids = []
+    texts = set()
+    for distance, id in zip(distances, ids):
+        text = chunk_texts.get(int(id))
+        if text is None or text in texts:
+            continue
+        if (not chunk_ids and distance >= 0.6) or distance >= 0.65:
+            chunk_ids.append(int(id))
+            texts.add(text)
+    return chunk_ids
+
+
+def diversify_chunk_ids(
+    query, chunk_ids, embeddings, k, weight=0.7, max_similarity=0.95
+):
+    if len(chunk_ids) <= 1:
+        return chunk_ids[:k]
+    X = np.vstack([embeddings[chunk_id] for chunk_id in chunk_ids])
+    faiss.normalize_L2(X)
+    relevance = X @ query
+    similarity = X @ X.T
+    redundancy = np.zeros(len(chunk_ids), dtype="float32")
+    available = np.ones(len(chunk_ids), dtype=bool)
+    selected = []
+    while len(selected) < k and available.any():
+        scores = np.where(
+            available, weight * relevance - (1 - weight) * redundancy, -np.inf
+        )
+        best = int(np.argmax(scores))
+        selected.append(chunk_ids[best])
+        redundancy = np.maximum(redundancy, similarity[best])
+        available[best] = False
+        available &= redundancy < max_similarity
+    return selected
+
+
+def search_faiss(connection, index, queries, k, diversify=False, lock=None):
+    lock = lock or contextlib.nullcontext()
+    faiss.normalize_L2(queries)
+    # The lock of a shared index is only held for the search itself, not for
+    # embedding the queries or loading the texts.
+    with lock:
+        D, I = index.search(
+            queries, k=k * 4 if diversify else k, params=make_search_parameters(index)
+        )
+    cursor = connection.cursor()
+    chunk_texts = load_chunk_texts(cursor, I.ravel())
+    selections = [
+        select_faiss_chunk_ids(distances, ids, chunk_texts)
+        for distances, ids in zip(D, I)
+    ]
+    if diversify:
+        embeddings = load_chunk_embeddings(
+            cursor, [chunk_id for chunk_ids in selections for chunk_id in chunk_ids]
+        )
+        selections = [
+            diversify_chunk_ids(query, chunk_ids, embeddings, k)
+            for query, chunk_ids in zip(queries, selections)
+        ]
+    return [
+        [chunk_texts[chunk_id] for chunk_id in chunk_ids] for chunk_ids in selections
+    ]
+
+
+def query_faiss(index, prompt, k=5, diversify=False, lock=None):
     texts = []
     with sqlite3.connect("data/rag.db") as connection:
         # status, embedding = embed_one("search_query: ", prompt)
-        event = embed_one("", prompt)
+        event = embed_one("", prompt, task="rag", keep_alive=EMBEDDING_KEEP_ALIVE)
+        if event["status"] == 200:
+            query = np.array(event["data"], dtype="float32").reshape(1, -1)
+            texts = search_faiss(connection, index, query, k, diversify, lock)[0]
+    return texts
+
+
+def query_faiss_many(index, prompts, k=5, diversify=False, lock=None):
+    texts = [[] for _ in prompts]
+    if not prompts:
+        return texts
+    with sqlite3.connect("data/rag.db") as connection:
+        # event = embed_multiple("search_query: ", prompts)
+        event = embed_multiple("", prompts, task="rag", keep_alive=EMBEDDING_KEEP_ALIVE)
+        if event["status"] == 200:
+            queries = np.array(event["data"], dtype="float32").reshape(len(prompts), -1)
+            texts = search_faiss(connection, index, queries, k, diversify, lock)
+    return texts
+
+
+def load_filtered_chunk_ids(cursor, project_name=None, page_ids=None, min_views=None):
+    conditions = ["chunks.status = 200"]
+    parameters = []
+    if project_name is not None:
+        conditions.append("projects.name = ?")
+        parameters.append(project_name)
+    if page_ids is not None:
+        conditions.append("chunks.page_id IN (SELECT value FROM json_each(?))")
+        parameters.append(json.dumps([int(page_id) for page_id in page_ids]))
+    if min_views is not None:
+        conditions.append("pages.views >= ?")
+        parameters.append(min_views)
+    cursor.execute(
+        "SELECT chunks.id "
+        "FROM chunks "
+        "INNER JOIN pages ON chunks.page_id = pages.id "
+        "INNER JOIN projects ON pages.project_id = projects.id "
+        "WHERE " + " AND ".join(conditions),
+        parameters,
+    )
+    return np.fromiter((chunk_id for (chunk_id,) in cursor), dtype="int64")
+
+
+def make_id_selector(chunk_ids):
+    chunk_ids = np.ascontiguousarray(chunk_ids, dtype="int64")
+    size = int(chunk_ids.max()) + 1
+    # A bitmap costs one bit per possible id, the batch selector a hash set entry
+    # per selected id, so dense selections are cheaper as a bitmap.
+    if size <= chunk_ids.size * 64:
+        bits = np.zeros(size, dtype=bool)
+        bits[chunk_ids] = True
+        bitmap = np.packbits(bits, bitorder="little")
+        # IDSelectorBitmap takes the length of the bitmap in bytes, not bits.
+        selector = faiss.IDSelectorBitmap(bitmap.size, faiss.swig_ptr(bitmap))
+        selector.referenced_objects = [bitmap]
+        return selector
+    return faiss.IDSelectorBatch(chunk_ids.size, faiss.swig_ptr(chunk_ids))
+
+
+def load_chunk_rows(cursor, chunk_ids):
+    return {
+        chunk_id: (page_id, text)
+        for chunk_id, page_id, text in cursor.execute(
+            "SELECT id, page_id, text FROM chunks WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps(sorted({int(id) for id in chunk_ids if id >= 0}))],
+        )
+    }
+
+
+def get_chunk_headline(text):
+    headline = None
+    for line in text.split("\n"):
+        if not line.startswith("#"):
+            break
+        headline = line.lstrip("#").strip()
+    return headline
+
+
+def query_faiss_filtered(
+    index,
+    prompt,
+    k=5,
+    project_name=None,
+    page_ids=None,
+    min_views=None,
+    min_score=0.6,
+    diversify=False,
+    lock=None,
+):
+    lock = lock or contextlib.nullcontext()
+    hits = []
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        chunk_ids = load_filtered_chunk_ids(cursor, project_name, page_ids, min_views)
+        if not chunk_ids.size:
+            return hits
+        # event = embed_one("search_query: ", prompt)
+        event = embed_one("", prompt, task="rag", keep_alive=EMBEDDING_KEEP_ALIVE)
         if event["status"] == 200:
             query = np.array(event["data"], dtype="float32").reshape(1, -1)
             faiss.normalize_L2(query)
-            D, I = index.search(query, k=k)
-            cursor = connection.cursor()
+            with lock:
+                chunk_ids = exclude_faiss_tombstones(index, chunk_ids)
+                if not chunk_ids.size:
+                    return hits
+                D, I = index.search(
+                    query,
+                    k=k * 4 if diversify else k,
+                    params=faiss.SearchParameters(sel=make_id_selector(chunk_ids)),
+                )
+            chunk_rows = load_chunk_rows(cursor, I[0])
+            texts = set()
             for distance, id in zip(D[0], I[0]):
-                for (text,) in cursor.execute(
-                    "SELECT text FROM chunks WHERE id = ?",
-                    [int(id)],
-                ):
-                    if (not texts and distance >= 0.6) or distance >= 0.65:
-                        if text not in texts:
-                            texts.append(text)
-    return texts
+                if int(id) not in chunk_rows or distance < min_score:
+                    continue
+                page_id, text = chunk_rows[int(id)]
+                if text in texts:
+                    continue
+                texts.add(text)
+                hits.append(
+                    {
+                        "chunk_id": int(id),
+                        "page_id": page_id,
+                        "headline": get_chunk_headline(text),
+                        "score": float(distance),
+                        "text": text,
+                    }
+                )
+            if diversify:
+                # Same MMR selection as the unfiltered search, over the
+                # candidates that passed the filter.
+                embeddings = load_chunk_embeddings(
+                    cursor, [hit["chunk_id"] for hit in hits]
+                )
+                hits_by_id = {hit["chunk_id"]: hit for hit in hits}
+                hits = [
+                    hits_by_id[chunk_id]
+                    for chunk_id in diversify_chunk_ids(
+                        query[0], list(hits_by_id), embeddings, k
+                    )
+                ]
+    return hits
 
 
+@cache_results
 def query_fts(term, k=5):
     texts = []
     with sqlite3.connect("data/rag.db") as connection:
@@ -208,38 +861,323 @@ def query_fts(term, k=5):
     return texts
 
 
-def search_wikipedia_term(term, min_views=1_000, k=5):
-    pages = []
+@cache_results
+def query_fts_snippets(term, k=5, tokens=24, weights=None, highlight=False):
+    snippets = []
+    query = sanitize_fts_query(term)
+    if not query:
+        return snippets
+    # FTS5 caps snippet windows at 64 tokens.
+    tokens = max(1, min(tokens, 64))
+    window = (
+        "highlight(chunks_fts, 0, '**', '**')"
+        if highlight
+        else f"snippet(chunks_fts, 0, '**', '**', '…', {int(tokens)})"
+    )
+    weights = ", ".join(str(float(weight)) for weight in weights or [1.0])
     with sqlite3.connect("data/rag.db") as connection:
         cursor = connection.cursor()
-        for (
-            page_id,
-            project_name,
-            page_name,
-            views,
-            status,
-        ) in cursor.execute(
-            "SELECT pages.id as page_id, projects.name as project_name, pages.name as page_name, pages.views as views, pages.status as status "
-            "FROM pages "
-            "INNER JOIN projects on pages.project_id = projects.id "
-            "INNER JOIN pages_fts ON pages_fts.rowid = pages.id "
-            "WHERE pages_fts.name MATCH ? "
-            "AND pages.views >= ? "
-            "ORDER BY pages_fts.rank, pages.views DESC "
+        for chunk_id, page_id, snippet, score in cursor.execute(
+            f"SELECT chunks.id as chunk_id, chunks.page_id, {window}, bm25(chunks_fts, {weights}) as score "
+            "FROM chunks "
+            "INNER JOIN chunks_fts ON chunks_fts.rowid = chunks.id "
+            "WHERE chunks_fts.text MATCH ? "
+            "ORDER BY score "
             "LIMIT ?",
-            [sanitize_fts_query(term), min_views, k],
+            [query, k],
         ):
-            pages.append(
+            snippets.append(
                 {
+                    "chunk_id": chunk_id,
                     "page_id": page_id,
-                    "project_name": project_name,
-                    "page_name": page_name,
-                    "views": views,
-                    "status": status,
+                    "snippet": snippet,
+                    "score": -score,
                 }
             )
+    return snippets
+
+
+def get_chunk(chunk_id):
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        for page_id, text in cursor.execute(
+            "SELECT page_id, text FROM chunks WHERE id = ?",
+            [chunk_id],
+        ):
+            return {"chunk_id": chunk_id, "page_id": page_id, "text": text}
+    return None
+
+
+def search_faiss_chunk_ids(index, prompt, k, lock=None):
+    lock = lock or contextlib.nullcontext()
+    # event = embed_one("search_query: ", prompt)
+    event = embed_one("", prompt, task="rag", keep_alive=EMBEDDING_KEEP_ALIVE)
+    if event["status"] != 200:
+        return []
+    query = np.array(event["data"], dtype="float32").reshape(1, -1)
+    faiss.normalize_L2(query)
+    with lock:
+        _, I = index.search(query, k=k, params=make_search_parameters(index))
+    return [int(id) for id in I[0] if id >= 0]
+
+
+def search_fts_chunk_ids(term, k):
+    query = sanitize_fts_query(term, "OR")
+    if not query:
+        return []
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        return [
+            chunk_id
+            for (chunk_id,) in cursor.execute(
+                "SELECT rowid FROM chunks_fts WHERE chunks_fts.text MATCH ? "
+                "ORDER BY rank "
+                "LIMIT ?",
+                [query, k],
+            )
+        ]
+
+
+def reciprocal_rank_fusion(rankings, weights, rrf_k=60):
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def search_hybrid_chunk_ids(
+    index,
+    prompt,
+    weights=(1.0, 1.0),
+    rrf_k=60,
+    candidates=20,
+    lock=None,
+):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        vector = executor.submit(
+            search_faiss_chunk_ids, index, prompt, candidates, lock
+        )
+        lexical = executor.submit(search_fts_chunk_ids, prompt, candidates)
+        return reciprocal_rank_fusion(
+            [vector.result(), lexical.result()], weights, rrf_k
+        )
+
+
+def query_hybrid(
+    index,
+    prompt,
+    k=5,
+    weights=(1.0, 1.0),
+    rrf_k=60,
+    candidates=20,
+    lock=None,
+):
+    chunk_ids = search_hybrid_chunk_ids(index, prompt, weights, rrf_k, candidates, lock)
+    texts = []
+    with sqlite3.connect("data/rag.db") as connection:
+        chunk_texts = load_chunk_texts(connection.cursor(), chunk_ids)
+    for chunk_id in chunk_ids:
+        text = chunk_texts.get(chunk_id)
+        if text is not None and text not in texts:
+            texts.append(text)
+            if len(texts) == k:
+                break
+    return texts
+
+
+def select_pages(cursor, joins, conditions, order, parameters):
+    return [
+        {
+            "page_id": page_id,
+            "project_name": project_name,
+            "page_name": page_name,
+            "views": views,
+            "status": status,
+        }
+        for page_id, project_name, page_name, views, status in cursor.execute(
+            "SELECT pages.id as page_id, projects.name as project_name, pages.name as page_name, pages.views as views, pages.status as status "
+            "FROM pages "
+            "INNER JOIN projects on pages.project_id = projects.id "
+            f"{joins} "
+            f"WHERE {conditions} "
+            "AND pages.views >= ? "
+            f"ORDER BY {order} "
+            "LIMIT ?",
+            parameters,
+        )
+    ]
+
+
+def is_missing_table(error):
+    return isinstance(error, sqlite3.OperationalError) and str(error).startswith(
+        "no such table"
+    )
+
+
+def search_title_prefixes(cursor, title, min_views, k):
+    # The views-ordered candidate lists are precomputed by build_title_index,
+    # so this is an index seek instead of sorting a match set.
+    if not title or len(title) > TITLE_PREFIX_LENGTH:
+        return []
+    try:
+        return select_pages(
+            cursor,
+            "INNER JOIN title_prefixes ON title_prefixes.page_id = pages.id",
+            "title_prefixes.prefix = ?",
+            "title_prefixes.views DESC",
+            [title, min_views, k],
+        )
+    except sqlite3.OperationalError as error:
+        # Databases without a title index fall back to FTS.
+        if is_missing_table(error):
+            return []
+        raise
+
+
+@cache_results
+def search_wikipedia_term(term, min_views=1_000, k=5):
+    pages = {}
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        for page in search_title_prefixes(cursor, normalize_title(term), min_views, k):
+            pages.setdefault(page["page_id"], page)
+        if len(pages) < k:
+            for page in select_pages(
+                cursor,
+                "INNER JOIN pages_fts ON pages_fts.rowid = pages.id",
+                "pages_fts.name MATCH ?",
+                "pages_fts.rank, pages.views DESC",
+                [sanitize_fts_query(term), min_views, k],
+            ):
+                pages.setdefault(page["page_id"], page)
+        connection.commit()
+    if not pages:
+        return search_wikipedia_title(term, min_views, k)
+    return list(pages.values())[:k]
+
+
+@cache_results
+def search_wikipedia_title(term, min_views=1_000, k=5, candidates=200):
+    title = normalize_title(term)
+    pages = {}
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        for page in search_title_prefixes(cursor, title, min_views, k):
+            pages.setdefault(page["page_id"], page)
+        try:
+            if len(pages) < k and len(title) >= 3:
+                for page in select_pages(
+                    cursor,
+                    "INNER JOIN pages_trigram ON pages_trigram.rowid = pages.id",
+                    "pages_trigram MATCH ?",
+                    "pages.views DESC",
+                    [trigram_fts_query(title), min_views, k],
+                ):
+                    pages.setdefault(page["page_id"], page)
+            if not pages and len(title) >= 3:
+                # Nothing contains the title verbatim, so rank by shared trigrams
+                # to tolerate typos. Only the best ranked candidates are joined,
+                # an OR of common trigrams matches a large part of all titles.
+                for page in select_pages(
+                    cursor,
+                    "INNER JOIN ("
+                    "SELECT rowid, rank FROM pages_trigram "
+                    "WHERE pages_trigram MATCH ? ORDER BY rank LIMIT ?"
+                    ") AS candidates ON candidates.rowid = pages.id",
+                    "1",
+                    "candidates.rank, pages.views DESC",
+                    [trigram_fts_query(title, fuzzy=True), candidates, min_views, k],
+                ):
+                    pages.setdefault(page["page_id"], page)
+        except sqlite3.OperationalError as error:
+            if not is_missing_table(error):
+                raise
+        connection.commit()
+    return list(pages.values())[:k]
+
+
+TITLE_INDEX_SQL = """
+create virtual table if not exists pages_trigram using fts5(
+    name,
+    content = 'pages',
+    content_rowid = 'id',
+    tokenize = 'trigram'
+);
+
+create trigger if not exists pages_trigram_ai
+after insert on pages
+begin
+    insert into pages_trigram(rowid, name)
+    values (new.id, new.name);
+end;
+
+create trigger if not exists pages_trigram_ad
+after delete on pages
+begin
+    insert into pages_trigram(pages_trigram, rowid, name)
+    values ('delete', old.id, old.name);
+end;
+
+create trigger if not exists pages_trigram_au
+after update of id, name on pages
+begin
+    insert into pages_trigram(pages_trigram, rowid, name)
+    values ('delete', old.id, old.name);
+    insert into pages_trigram(rowid, name)
+    values (new.id, new.name);
+end;
+
+create table if not exists title_prefixes (
+    prefix text not null,
+    views integer not null,
+    page_id integer not null,
+    constraint fk_page foreign key (page_id) references pages(id)
+);
+
+create index if not exists title_prefixes_prefix_views on title_prefixes(prefix, views desc);
+"""
+
+
+def build_title_index(limit=100_000, per_prefix=10):
+    with sqlite3.connect("data/rag.db") as connection:
+        # Same as sql/model.sql, for databases created before the title index.
+        connection.executescript(TITLE_INDEX_SQL)
+        cursor1 = connection.cursor()
+        cursor2 = connection.cursor()
+        cursor2.execute("INSERT INTO pages_trigram(pages_trigram) VALUES ('rebuild')")
+        cursor2.execute("DELETE FROM title_prefixes")
+        counts = {}
+
+        def prefixes():
+            for page_id, page_name, views in cursor1.execute(
+                "SELECT id, name, views FROM pages ORDER BY views DESC LIMIT ?",
+                [limit],
+            ):
+                title = normalize_title(page_name)
+                for length in range(1, min(len(title), TITLE_PREFIX_LENGTH) + 1):
+                    prefix = title[:length]
+                    if counts.get(prefix, 0) < per_prefix:
+                        counts[prefix] = counts.get(prefix, 0) + 1
+                        yield prefix, views, page_id
+
+        for batch in batched(prefixes(), n=10_000):
+            cursor2.executemany(
+                "INSERT INTO title_prefixes (prefix, views, page_id) VALUES (?, ?, ?)",
+                batch,
+            )
         connection.commit()
-    return pages
+
+
+def optimize_fts_indexes(terms=("google", "berlin wall", "history")):
+    with sqlite3.connect("data/rag.db") as connection:
+        before = report_fts(connection, FTS_TABLES, terms)
+        for table in FTS_TABLES:
+            configure_fts(connection, table)
+            optimize_fts(connection, table)
+            connection.commit()
+        after = report_fts(connection, FTS_TABLES, terms)
+    return before, after
 
 
 def get_and_update_wikipedia_page(cursor, page_id, project_name, page_name):
@@ -277,19 +1215,65 @@ def scrape_wikipedia_pages(limit):
         connection.commit()
 
 
-def update_wikipedia_sections(cursor, page_id, html):
+def parse_wikipedia_sections(html):
     parser = WikipediaHTMLParser()
     parser.feed(html)
     # print(parser.markdown)
     markdown = "".join(parser.markdown)
-    update_page_markdown(cursor, page_id, markdown)
     # print(parser.sections)
+    texts = []
+    for section in parser.sections:
+        text = "\n".join(section[0]) + "\n" + "\n".join(section[1])
+        # print(text)
+        texts.append(text)
+    return markdown, texts
+
+
+def embed_wikipedia_chunks(sections):
+    # One embed call for the sections of all pages. A failed call raises, so
+    # no page is marked as extracted without its chunks.
+    rows = [(page_id, text) for page_id, texts in sections for text in texts]
+    if not rows:
+        return []
+    # event = embed_multiple("search_document: ", texs)
+    event = embed_multiple(
+        "",
+        [text for _, text in rows],
+        task="rag",
+        keep_alive=EMBEDDING_KEEP_ALIVE,
+    )
+    if event["status"] != 200:
+        raise RuntimeError(f"Embedding sections failed with status {event['status']}")
+    embeddings = []
+    for document in event["data"]:
+        embedding = np.array(document).astype("float32").tobytes()
+        assert all(np.isclose(document, np.frombuffer(embedding, dtype="float32")))
+        embeddings.append(embedding)
+    return [
+        (page_id, text, event["status"], sqlite3.Binary(embedding))
+        for (page_id, text), embedding in zip(rows, embeddings)
+    ]
+
+
+def store_wikipedia_chunks(cursor, chunks):
+    cursor.executemany(
+        "INSERT OR IGNORE INTO chunks (page_id, text, status, embedding) VALUES (?, ?, ?, ?)",
+        chunks,
+    )
+
+
+def update_wikipedia_sections(cursor, page_id, html):
+    markdown, texts = parse_wikipedia_sections(html)
+    # Embedded before anything is written, so no write transaction is held
+    # during the embed call.
+    chunks = embed_wikipedia_chunks([(page_id, texts)])
+    update_page_markdown(cursor, page_id, markdown)
     """
     for section in parser.sections:
         text = "\n".join(section[0]) + "\n" + "\n".join(section[1])
         # print(text)
         # event = embed_one("search_document: ", text)
-        event = embed_one("", text)
+        event = embed_one("", text, task="rag", keep_alive=EMBEDDING_KEEP_ALIVE)
         if event["status"] == 200:
             embedding = np.array(event["data"]).astype("float32").tobytes()
             assert all(
@@ -305,26 +1289,7 @@ def update_wikipedia_sections(cursor, page_id, html):
                 ],
             )
     """
-    texts = []
-    for section in parser.sections:
-        text = "\n".join(section[0]) + "\n" + "\n".join(section[1])
-        # print(text)
-        texts.append(text)
-    # event = embed_multiple("search_document: ", texs)
-    event = embed_multiple("", texts)
-    if event["status"] == 200:
-        embeddings = []
-        for document in event["data"]:
-            embedding = np.array(document).astype("float32").tobytes()
-            assert all(np.isclose(document, np.frombuffer(embedding, dtype="float32")))
-            embeddings.append(embedding)
-        cursor.executemany(
-            "INSERT OR IGNORE INTO chunks (page_id, text, status, embedding) VALUES (?, ?, ?, ?)",
-            [
-                (page_id, text, event["status"], sqlite3.Binary(embedding))
-                for text, embedding in zip(texts, embeddings)
-            ],
-        )
+    store_wikipedia_chunks(cursor, chunks)
 
 
 def extract_wikipedia_sections():
@@ -341,37 +1306,234 @@ def extract_wikipedia_sections():
             connection.commit()
 
 
+def fetch_wikipedia_pages(project_name, page_names, max_workers=4):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(
+            zip(
+                page_names,
+                executor.map(
+                    lambda page_name: get_wikipedia_page(project_name, page_name),
+                    page_names,
+                ),
+            )
+        )
+
+
+def prepare_wikipedia_pages(project_name, page_names):
+    # Fetches, parses and embeds the pages without touching the FAISS index, so
+    # callers can run this outside of their index lock.
+    statuses = {page_name: 404 for page_name in page_names}
+    markdowns = {}
+    sections = []
+    with sqlite3.connect("data/rag.db") as connection:
+        cursor = connection.cursor()
+        rows = list(
+            cursor.execute(
+                "SELECT pages.id as page_id, pages.name as page_name, pages.status as status, pages.html, pages.markdown "
+                "FROM pages INNER JOIN projects on pages.project_id = projects.id "
+                "WHERE projects.name = ? AND pages.name IN (SELECT value FROM json_each(?))",
+                [project_name, json.dumps(page_names)],
+            )
+        )
+        pages = fetch_wikipedia_pages(
+            project_name,
+            [page_name for _, page_name, status, _, _ in rows if not status],
+        )
+        for page_id, page_name, status, html_compressed, markdown in rows:
+            if page_name in pages:
+                status, html = pages[page_name]
+                html_compressed = zlib.compress(html.encode("utf-8")) if html else None
+                update_page_status_html(cursor, page_id, status, html_compressed)
+            statuses[page_name] = status
+            if html_compressed and not markdown:
+                html = zlib.decompress(html_compressed).decode("utf-8")
+                markdowns[page_id], texts = parse_wikipedia_sections(html)
+                sections.append((page_id, texts))
+        # The fetched pages are kept even if embedding fails, and no write
+        # transaction is open during the embed call.
+        connection.commit()
+        chunks = embed_wikipedia_chunks(sections)
+        for page_id, markdown in markdowns.items():
+            update_page_markdown(cursor, page_id, markdown)
+        store_wikipedia_chunks(cursor, chunks)
+        connection.commit()
+    return statuses, list(markdowns)
+
+
+def index_wikipedia_pages(index, page_ids):
+    if page_ids:
+        with sqlite3.connect("data/rag.db") as connection:
+            update_faiss(connection, index, page_ids)
+            connection.commit()
+    RESULT_CACHE.invalidate()
+    return index
+
+
+def ingest_wikipedia_pages(index, project_name, page_names):
+    statuses, page_ids = prepare_wikipedia_pages(project_name, page_names)
+    index_wikipedia_pages(index, page_ids)
+    return statuses
+
+
 def ingest_wikipedia_page(index, project_name, page_name):
+    return ingest_wikipedia_pages(index, project_name, [page_name])[page_name]
+
+
+def reextract_wikipedia_page(index, project_name, page_name):
     status = 404
     with sqlite3.connect("data/rag.db") as connection:
-        cursor1 = connection.cursor()
-        cursor2 = connection.cursor()
-        for (
-            page_id,
-            status,
-            html_compressed,
-            markdown,
-        ) in cursor1.execute(
-            "SELECT pages.id as page_id, pages.status as status, pages.html, pages.markdown "
-            "FROM pages INNER JOIN projects on pages.project_id = projects.id "
-            "WHERE projects.name = ? AND pages.name = ?",
-            [project_name, page_name],
+        migrate_fts_triggers(connection)
+        cursor = connection.cursor()
+        for page_id, status, html_compressed in list(
+            cursor.execute(
+                "SELECT pages.id as page_id, pages.status as status, pages.html "
+                "FROM pages INNER JOIN projects on pages.project_id = projects.id "
+                "WHERE projects.name = ? AND pages.name = ?",
+                [project_name, page_name],
+            )
         ):
-            if not status:
-                status, html_compressed = get_and_update_wikipedia_page(
-                    cursor2, page_id, project_name, page_name
-                )
-            if html_compressed and not markdown:
+            # Embedded before the old chunks are deleted, so a failed embed call
+            # leaves the page as it was.
+            markdown = None
+            chunks = []
+            if html_compressed:
                 html = zlib.decompress(html_compressed).decode("utf-8")
-                update_wikipedia_sections(connection, page_id, html)
-                update_faiss(connection, index, page_id)
+                markdown, texts = parse_wikipedia_sections(html)
+                chunks = embed_wikipedia_chunks([(page_id, texts)])
+            delete_page_chunks(connection, index, page_id)
+            update_page_markdown(cursor, page_id, markdown)
+            store_wikipedia_chunks(cursor, chunks)
+            update_faiss(connection, index, page_id)
             break
         connection.commit()
+        RESULT_CACHE.invalidate()
+        maybe_compact_faiss(connection, index)
         return status
 
 
+def delete_wikipedia_page(index, project_name, page_name):
+    with sqlite3.connect("data/rag.db") as connection:
+        migrate_fts_triggers(connection)
+        cursor = connection.cursor()
+        page_ids = list(
+            cursor.execute(
+                "SELECT pages.id as page_id "
+                "FROM pages INNER JOIN projects on pages.project_id = projects.id "
+                "WHERE projects.name = ? AND pages.name = ?",
+                [project_name, page_name],
+            )
+        )
+        for (page_id,) in page_ids:
+            delete_page_chunks(connection, index, page_id)
+            cursor.execute("DELETE FROM pages WHERE id = ?", [page_id])
+        connection.commit()
+        RESULT_CACHE.invalidate()
+        maybe_compact_faiss(connection, index)
+        return bool(page_ids)
+
+
+class ReadOnlyPool:
+    # Pooled read-only connections for SQL written by the model, with a
+    # statement timeout and caps on the rows and bytes returned.
+    def __init__(
+        self,
+        path,
+        max_connections=4,
+        timeout=5.0,
+        max_rows=200,
+        max_bytes=32_000,
+        batch_size=50,
+    ):
+        self.path = path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.connections = queue.Queue()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    @contextlib.contextmanager
+    def connect(self):
+        with self.lock:
+            connection = None
+            if self.connections.empty() and self.count < self.max_connections:
+                connection = self.open()
+                self.count += 1
+        if connection is None:
+            connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            connection.rollback()
+            self.connections.put(connection)
+
+    def execute(self, query, parameters, timeout=None, max_rows=None, max_bytes=None):
+        timeout = timeout or self.timeout
+        max_rows = max_rows or self.max_rows
+        max_bytes = max_bytes or self.max_bytes
+        start = time.monotonic()
+        deadline = start + timeout
+        header = []
+        rows = []
+        size = 0
+        truncated = None
+        with self.connect() as connection:
+            # SQLite calls the handler every 1000 virtual machine instructions,
+            # returning True aborts the statement.
+            connection.set_progress_handler(lambda: time.monotonic() > deadline, 1_000)
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, parameters)
+                header = [desc[0] for desc in cursor.description or []]
+                while truncated is None:
+                    batch = cursor.fetchmany(self.batch_size)
+                    if not batch:
+                        break
+                    for values in batch:
+                        row = {key: value for key, value in zip(header, values)}
+                        row_size = len(json.dumps(row, default=str))
+                        if len(rows) >= max_rows:
+                            truncated = "rows"
+                        elif size + row_size > max_bytes:
+                            truncated = "bytes"
+                        if truncated:
+                            break
+                        rows.append(row)
+                        size += row_size
+            except sqlite3.OperationalError as error:
+                if str(error) == "interrupted":
+                    raise TimeoutError(
+                        f"Query took longer than {timeout} seconds"
+                    ) from error
+                raise
+            finally:
+                cursor.close()
+                connection.set_progress_handler(None, 0)
+        return {
+            "columns": header,
+            "rows": rows,
+            "row_count": len(rows),
+            "truncated": truncated is not None,
+            "truncated_by": truncated,
+            "max_rows": max_rows,
+            "max_bytes": max_bytes,
+            "seconds": time.monotonic() - start,
+        }
+
+
+CATALOG_POOL = ReadOnlyPool("data/catalog.db")
+
+
 def get_sqlite_schema():
-    with sqlite3.connect("data/catalog.db") as connection:
+    with CATALOG_POOL.connect() as connection:
         schema = {"tables": {}}
         cursor1 = connection.cursor()
         for name, sql in cursor1.execute(
@@ -386,7 +1548,7 @@ def get_sqlite_schema():
 
 
 def get_sqlite_tables():
-    with sqlite3.connect("data/catalog.db") as connection:
+    with CATALOG_POOL.connect() as connection:
         cursor = connection.cursor()
         tables = list(
             cursor.execute(
@@ -401,7 +1563,7 @@ def get_sqlite_tables():
 
 
 def get_sqlite_table(table):
-    with sqlite3.connect("data/catalog.db") as connection:
+    with CATALOG_POOL.connect() as connection:
         cursor = connection.cursor()
         sql = list(
             cursor.execute(
@@ -415,16 +1577,7 @@ def get_sqlite_table(table):
 
 def query_sqlite(query, parameters):
     parameters = parameters or {}
-    with sqlite3.connect("data/catalog.db") as connection:
-        rows = []
-        cursor = connection.cursor()
-        cursor.execute(query, parameters)
-        header = [desc[0] for desc in cursor.description]
-        for values in cursor.fetchall():
-            row = {key: value for key, value in zip(header, values)}
-            rows.append(row)
-        connection.commit()
-        return rows
+    return CATALOG_POOL.execute(query, parameters)
 
 
 def get_nesting_depth(obj, depth=0):
@@ -67,7 +67,7 @@ TOOLS = [
             "type": "function",
             "function": {
                 "name": "query_sqlite",
-                "description": "Executes a read-only SQL query against the SQLite database and returns the result rows.",
+                "description": "Executes a read-only SQL query against the SQLite database and returns the column names and result rows. Queries time out after a few seconds and at most 200 rows are returned, truncated is true when the result had more rows.",
                 "parameters": {
                     "type": "object",
                     "properties": {
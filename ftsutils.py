@@ -1,10 +1,12 @@
 import re
+import sqlite3
+import time
 
 _FTS_SYNTAX_RE = re.compile(r'[()"*.:]')
 _FTS_KEYWORDS = {"and", "or", "not", "near"}
 
 
-def sanitize_fts_query(user_input: str) -> str:
+def sanitize_fts_query(user_input: str, operator: str = "AND") -> str:
     if not user_input:
         return ""
     text = user_input.lower()
@@ -14,4 +16,108 @@ def sanitize_fts_query(user_input: str) -> str:
     tokens = [token for token in raw_tokens if token not in _FTS_KEYWORDS]
     if not tokens:
         return ""
-    return " AND ".join(f'"{t}"' for t in tokens)
+    return f" {operator} ".join(f'"{t}"' for t in tokens)
+
+
+def normalize_title(user_input: str) -> str:
+    return "_".join(user_input.lower().split())
+
+
+def trigram_fts_query(title: str, fuzzy: bool = False) -> str:
+    if not fuzzy:
+        return '"{}"'.format(title.replace('"', '""'))
+    trigrams = sorted({title[i : i + 3] for i in range(len(title) - 2)})
+    return " OR ".join('"{}"'.format(t.replace('"', '""')) for t in trigrams)
+
+
+_FTS_STRUCTURE_V2 = b"\xff\x00\x00\x01"
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = 0
+    for i in range(8):
+        byte = data[offset + i]
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, offset + i + 1
+    return (value << 8) | data[offset + 8], offset + 9
+
+
+def count_fts_segments(connection, table: str) -> int:
+    rows = list(connection.execute(f"SELECT block FROM {table}_data WHERE id = 10"))
+    if not rows:
+        return 0
+    structure = rows[0][0]
+    offset = 8 if structure[4:8] == _FTS_STRUCTURE_V2 else 4
+    _, offset = _read_varint(structure, offset)
+    segments, _ = _read_varint(structure, offset)
+    return segments
+
+
+def configure_fts(connection, table: str, automerge: int = 8, crisismerge: int = 32):
+    for option, value in [("automerge", automerge), ("crisismerge", crisismerge)]:
+        connection.execute(
+            f"INSERT INTO {table}({table}, rank) VALUES (?, ?)", [option, value]
+        )
+
+
+def merge_fts(connection, table: str, pages: int = 500) -> bool:
+    changes = connection.total_changes
+    connection.execute(
+        f"INSERT INTO {table}({table}, rank) VALUES ('merge', ?)", [pages]
+    )
+    # SQLite documents that fewer than two changes mean no merge work was left.
+    return connection.total_changes - changes >= 2
+
+
+def optimize_fts(connection, table: str):
+    connection.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+
+
+def measure_fts_latency(connection, table: str, terms: list[str], k: int = 10) -> float:
+    start = time.perf_counter()
+    for term in terms:
+        query = sanitize_fts_query(term)
+        if query:
+            list(
+                connection.execute(
+                    f"SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rank LIMIT ?",
+                    [query, k],
+                )
+            )
+    return (time.perf_counter() - start) * 1000 / max(len(terms), 1)
+
+
+def report_fts(connection, tables: list[str], terms: list[str]) -> dict:
+    return {
+        table: {
+            "segments": count_fts_segments(connection, table),
+            "latency_ms": measure_fts_latency(connection, table, terms),
+        }
+        for table in tables
+    }
+
+
+def maintain_fts(
+    path: str,
+    tables: list[str],
+    is_idle,
+    stop,
+    pages=500,
+    interval=5.0,
+    busy_timeout=1.0,
+):
+    # Merges compete with ingestion for the write lock, so wait briefly for it
+    # and retry on the next interval instead of ending the maintenance thread.
+    with sqlite3.connect(path, timeout=busy_timeout) as connection:
+        while not stop.wait(interval):
+            for table in tables:
+                try:
+                    while is_idle() and not stop.is_set():
+                        merged = merge_fts(connection, table, pages)
+                        connection.commit()
+                        if not merged:
+                            break
+                except sqlite3.OperationalError as error:
+                    print("fts maintenance of", table, "failed:", error)
+                    connection.rollback()
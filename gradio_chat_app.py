@@ -19,6 +19,10 @@ def run_chat(message, history):
     return ""
 
 
-gr.ChatInterface(
+demo = gr.ChatInterface(
     fn=run_chat,
-).launch()
+)
+
+
+if __name__ == "__main__":
+    demo.launch()
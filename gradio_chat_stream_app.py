@@ -1,29 +1,30 @@
 import json
 import gradio as gr
-from dbutils import (
+from retrievalutils import (
     search_wikipedia_term,
     ingest_wikipedia_page,
-    load_faiss,
     query_faiss,
     query_fts,
+)
+from dbutils import (
     get_sqlite_schema,
     get_sqlite_tables,
     get_sqlite_table,
     query_sqlite,
 )
-from llmutils import chat_stream
+from llmutils import CONTEXT_BUDGET, chat_stream
 from env import SYSTEM_PROMPT, TOOLS
 
 """
-INDEX = load_faiss()
 TOOLS[0]["handler"] = lambda tool_call: query_faiss(
-    INDEX, tool_call["function"]["arguments"]["prompt"]
+    tool_call["function"]["arguments"]["prompt"],
+    page_ids=tool_call["function"]["arguments"].get("page_ids"),
+    min_views=tool_call["function"]["arguments"].get("min_views"),
 )
 TOOLS[1]["handler"] = lambda tool_call: search_wikipedia_term(
     tool_call["function"]["arguments"]["term"]
 )
 TOOLS[2]["handler"] = lambda tool_call: ingest_wikipedia_page(
-    INDEX,
     tool_call["function"]["arguments"]["project_name"],
     tool_call["function"]["arguments"]["page_name"],
 )
@@ -63,9 +64,12 @@ def run_chat_stream(message, history):
     assert len(messages) == 0 or messages[-1]["role"] != "user"
     messages.append({"role": "user", "content": message})
     response = {"thinking": "", "tooling": "", "content": ""}
-    for event in chat_stream(messages, TOOLS):
+    for event in chat_stream(
+        messages, tools=TOOLS, task="rag", context_budget=CONTEXT_BUDGET
+    ):
         assert event["status"] == 200
-        response[event["type"]] += event["data"]
+        if event["type"] in response:
+            response[event["type"]] += event["data"]
         yield (
             response["thinking"],
             json.dumps(response["tooling"], indent=2),
@@ -86,4 +90,7 @@ with gr.Blocks() as demo:
         inputs=[message, chatbot],
         outputs=[thinking_box, tooling_box, chatbot, message],
     )
+
+
+if __name__ == "__main__":
     demo.launch()
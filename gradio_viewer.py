@@ -1,10 +1,13 @@
 import json
+import os
 import sqlite3
 import gradio as gr
 
 
 def load_data(project_name="proart"):
     pages = []
+    if not os.path.exists("data/rag.db"):
+        return pages
     with sqlite3.connect("data/rag.db") as connection:
         cursor = connection.cursor()
         for (
@@ -28,7 +31,8 @@ def load_data(project_name="proart"):
     return pages
 
 
-data = load_data()
+# Loaded when the page is opened, not on import.
+data = []
 
 
 def format_for_table(records):
@@ -94,6 +98,7 @@ with gr.Blocks(title="JSON Table Browser") as demo:
     )
     table.select(display_json, inputs=[filtered_state], outputs=[json_viewer])
     reload_button.click(reload_data, outputs=[table, filtered_state, search_box])
+    demo.load(reload_data, outputs=[table, filtered_state, search_box])
 
 
 if __name__ == "__main__":
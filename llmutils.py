@@ -1,60 +1,526 @@
+import concurrent.futures
+import hashlib
+import http.client
 import json
-import urllib.request
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
 from urllib.error import HTTPError
 
+OLLAMA_URLS = ["http://localhost:11434"]
+HEALTH_INTERVAL = 10.0
+HEALTH_TIMEOUTS = {"connect": 2.0, "first_token": 5.0, "total": 5.0}
+# An endpoint that already has the model loaded is preferred as long as it
+# has at most this many more requests in flight than the least busy endpoint.
+AFFINITY_SLACK = 2
+TIMEOUTS = {"connect": 10.0, "first_token": 300.0, "total": 900.0}
+RETRIES = 2
+BACKOFF = 0.5
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+LATENCY_HISTOGRAMS = {}
+LATENCY_LOCK = threading.Lock()
+TOOL_WORKERS = 8
+TOOL_TIMEOUT = 120.0
+TOOL_EXECUTORS = {}
+TOOL_LOCK = threading.Lock()
+CONTEXT_BUDGET = 6_000
+CHARS_PER_TOKEN = 4
+COMPACTED_LENGTH = 400
+METRICS_PATH = "data/ollama_metrics.jsonl"
+METRIC_FIELDS = [
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+]
 
-def embed_one(tip, document_or_query, model="bge-m3"):
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+# OSError covers URLError, timeouts, refused connections and resolver errors.
+OLLAMA_ERRORS = (OSError, http.client.HTTPException)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let one trial request through and keep shedding the
+                # rest until it reports back.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def is_available(self):
+        with self.lock:
+            return (
+                self.opened_at is None
+                or time.monotonic() - self.opened_at >= self.reset_timeout
+            )
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def record_latency(endpoint, seconds, error=False):
+    with LATENCY_LOCK:
+        histogram = LATENCY_HISTOGRAMS.setdefault(
+            endpoint,
+            {
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                "count": 0,
+                "sum": 0.0,
+                "errors": 0,
+            },
+        )
+        bucket = sum(seconds > bound for bound in LATENCY_BUCKETS)
+        histogram["buckets"][bucket] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["errors"] += error
+
+
+def get_latency_histograms():
+    with LATENCY_LOCK:
+        return {
+            endpoint: {
+                "buckets": dict(
+                    zip(
+                        [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                        histogram["buckets"],
+                    )
+                ),
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "errors": histogram["errors"],
+            }
+            for endpoint, histogram in LATENCY_HISTOGRAMS.items()
+        }
+
+
+class OllamaEndpoint:
+    def __init__(self, url):
+        self.url = url
+        self.breaker = CircuitBreaker()
+        self.healthy = True
+        self.models = set()
+        self.outstanding = 0
+        self.requests = 0
+
+
+class OllamaPool:
+    def __init__(self, urls, health_interval=HEALTH_INTERVAL):
+        self.endpoints = [OllamaEndpoint(url) for url in urls]
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.checker = None
+
+    def acquire(self, model, excluded):
+        # Health checks run in a thread started with the first request, so that
+        # importing llmutils stays free of side effects.
+        if self.checker is None and self.health_interval:
+            self.checker = threading.Thread(target=self.check_periodically, daemon=True)
+            self.checker.start()
+        with self.lock:
+            candidates = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint not in excluded
+                and endpoint.healthy
+                and endpoint.breaker.is_available()
+            ]
+            if not candidates:
+                return None
+            # outstanding only counts this process's requests. The ProArt
+            # scripts run one pool per worker process, so routing between them
+            # is approximate and an endpoint can get more than its share.
+            least_busy = min(candidates, key=lambda endpoint: endpoint.outstanding)
+            loaded = [endpoint for endpoint in candidates if model in endpoint.models]
+            chosen = least_busy
+            if loaded:
+                affine = min(loaded, key=lambda endpoint: endpoint.outstanding)
+                if affine.outstanding <= least_busy.outstanding + AFFINITY_SLACK:
+                    chosen = affine
+            if not chosen.breaker.allow():
+                return None
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, endpoint, model, error=None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is None and model:
+                endpoint.models.add(model)
+        # Client errors such as an unknown model, and errors that are not
+        # Ollama's at all, say nothing about the health of the endpoint.
+        if error is None:
+            endpoint.breaker.record_success()
+        elif isinstance(error, OLLAMA_ERRORS) and is_retryable(error):
+            endpoint.breaker.record_failure()
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            models = fetch_loaded_models(endpoint.url)
+            with self.lock:
+                endpoint.healthy = models is not None
+                if models is not None:
+                    endpoint.models = set(models)
+
+    def check_periodically(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                endpoint.url: {
+                    "healthy": endpoint.healthy,
+                    "available": endpoint.breaker.is_available(),
+                    "outstanding": endpoint.outstanding,
+                    "requests": endpoint.requests,
+                    "models": sorted(endpoint.models),
+                }
+                for endpoint in self.endpoints
+            }
+
+
+OLLAMA_POOL = OllamaPool(OLLAMA_URLS)
+
+
+def configure_ollama_pool(urls, health_interval=HEALTH_INTERVAL):
+    global OLLAMA_POOL
+    OLLAMA_POOL = OllamaPool(urls, health_interval)
+    return OLLAMA_POOL
+
+
+class OllamaResponse:
+    def __init__(
+        self,
+        pool,
+        backend,
+        model,
+        connection,
+        sock,
+        response,
+        endpoint,
+        start,
+        deadline,
+    ):
+        self.pool = pool
+        self.backend = backend
+        self.model = model
+        self.connection = connection
+        self.sock = sock
+        self.response = response
+        self.status = response.status
+        self.endpoint = endpoint
+        self.start = start
+        self.deadline = deadline
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.response.close()
+        self.connection.close()
+        failed = exc_type is not None and issubclass(exc_type, OLLAMA_ERRORS)
+        self.pool.release(self.backend, self.model, exc_value if failed else None)
+        record_latency(self.endpoint, time.monotonic() - self.start, failed)
+
+    def __iter__(self):
+        while True:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"{self.endpoint} exceeded its total timeout")
+            if not self.response.isclosed():
+                self.sock.settimeout(remaining)
+            line = self.response.readline()
+            if not line:
+                return
+            yield json.loads(line)
+
+
+def connect_ollama(url, endpoint, data, timeouts):
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(
+        parts.hostname, parts.port, timeout=timeouts["connect"]
+    )
+    try:
+        connection.connect()
+        # The connection forgets its socket once a closing response arrives, so
+        # keep it for the read timeouts.
+        sock = connection.sock
+        sock.settimeout(timeouts["first_token"])
+        connection.request(
+            "GET" if data is None else "POST",
+            endpoint,
+            body=data,
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        if response.status >= 400:
+            raise HTTPError(
+                url + endpoint,
+                response.status,
+                response.reason,
+                response.headers,
+                response,
+            )
+    except BaseException:
+        connection.close()
+        raise
+    return connection, sock, response
+
+
+def is_retryable(error):
+    if isinstance(error, HTTPError):
+        return error.status == 429 or error.status >= 500
+    return not isinstance(error, CircuitOpenError)
+
+
+def open_ollama(endpoint, payload, timeouts=None, retries=RETRIES):
+    # Every Ollama endpoint is stateless, so a request that failed before any
+    # response line was read can be resent as is. A failed attempt fails over
+    # to the next endpoint of the pool, backing off only once every endpoint
+    # has failed.
+    timeouts = {**TIMEOUTS, **(timeouts or {})}
+    if payload and (
+        payload.get("stream") is False or endpoint in ["/api/embed", "/api/embeddings"]
+    ):
+        # Without streaming, the headers only arrive with the whole answer.
+        timeouts["first_token"] = timeouts["total"]
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    model = get_model_name(payload["model"]) if payload else None
+    pool = OLLAMA_POOL
+    start = time.monotonic()
+    failed = []
+    backoffs = 0
+    for attempt in range(retries + 1):
+        backend = pool.acquire(model, failed)
+        if backend is None and failed:
+            time.sleep(BACKOFF * 2**backoffs * random.uniform(0.5, 1.5))
+            backoffs += 1
+            failed = []
+            backend = pool.acquire(model, failed)
+        if backend is None:
+            record_latency(endpoint, time.monotonic() - start, True)
+            raise CircuitOpenError(f"no Ollama endpoint available for {endpoint}")
+        try:
+            connection, sock, response = connect_ollama(
+                backend.url, endpoint, data, timeouts
+            )
+        except OLLAMA_ERRORS as error:
+            pool.release(backend, model, error)
+            if attempt == retries or not is_retryable(error):
+                record_latency(endpoint, time.monotonic() - start, True)
+                raise
+            failed.append(backend)
+            continue
+        except BaseException as error:
+            pool.release(backend, model, error)
+            raise
+        return OllamaResponse(
+            pool,
+            backend,
+            model,
+            connection,
+            sock,
+            response,
+            endpoint,
+            start,
+            start + timeouts["total"],
+        )
+
+
+def record_metrics(endpoint, model, task, answer, format=None):
+    # The final message of every call carries Ollama's timings (in nanoseconds)
+    # and token counts. They are appended to a JSONL file shared by all worker
+    # processes, see metricsutils for the aggregation.
+    metrics = {
+        "time": time.time(),
+        "endpoint": endpoint,
+        "model": model,
+        "task": task,
+        "format": "schema" if isinstance(format, dict) else format,
+    }
+    for field in METRIC_FIELDS:
+        metrics[field] = answer.get(field)
+    if METRICS_PATH:
+        os.makedirs(os.path.dirname(METRICS_PATH) or ".", exist_ok=True)
+        with open(METRICS_PATH, "a") as file:
+            file.write(json.dumps(metrics) + "\n")
+    return metrics
+
+
+class ResponseCache:
+    def __init__(self, path="data/llm_cache.db", max_entries=100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used "
+                "ON responses (last_used)"
+            )
+
+    def get(self, key):
+        with sqlite3.connect(self.path, timeout=30.0) as connection:
+            row = connection.execute(
+                "SELECT response FROM responses WHERE key = ?", [key]
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", [time.time(), key]
+            )
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        with sqlite3.connect(self.path, timeout=30.0) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, last_used) "
+                "VALUES (?, ?, ?)",
+                [key, json.dumps(response), time.time()],
+            )
+            (count,) = connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                cursor = connection.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                    [count - self.max_entries],
+                )
+                self.evictions += cursor.rowcount
+
+    def clear(self):
+        with sqlite3.connect(self.path, timeout=30.0) as connection:
+            connection.execute("DELETE FROM responses")
+
+    def get_stats(self):
+        with sqlite3.connect(self.path, timeout=30.0) as connection:
+            (size,) = connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        requests = self.hits + self.misses
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+def is_deterministic(options):
+    # Only seeded or greedy requests reproduce their answer, anything else is a
+    # sampling run whose repetitions must reach the model.
+    return bool(options) and ("seed" in options or options.get("temperature") == 0)
+
+
+def get_cache_key(payload):
+    request = {
+        key: payload.get(key)
+        for key in ["model", "messages", "format", "think", "options"]
+    }
+    return hashlib.sha256(
+        json.dumps(
+            request, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def embed_one(
+    tip, document_or_query, model="bge-m3", timeouts=None, task=None, keep_alive=None
+):
     # model = "nomic-embed-text"
     # model = "bge-m3"
     # model = "qwen3-embedding"
     prompt = tip + document_or_query
+    payload = {"model": model, "prompt": prompt}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
     try:
-        with urllib.request.urlopen(
-            "http://localhost:11434/api/embeddings",
-            data=json.dumps({"model": model, "prompt": prompt}).encode("utf-8"),
-        ) as response:
+        with open_ollama("/api/embeddings", payload, timeouts) as response:
             status = response.status
-            answer = json.loads(response.read().decode("utf-8"))
-            embedding = answer["embedding"]
-    except HTTPError as e:
-        status = e.status
+            for answer in response:
+                embedding = answer["embedding"]
+                record_metrics("/api/embeddings", model, task, answer)
+    except OLLAMA_ERRORS as e:
+        status = getattr(e, "status", None)
         embedding = None
     return {"type": "embedding", "status": status, "data": embedding}
 
 
-def embed_multiple(tip, documents_or_queries, model="bge-m3"):
+def embed_multiple(
+    tip,
+    documents_or_queries,
+    model="bge-m3",
+    timeouts=None,
+    task=None,
+    keep_alive=None,
+):
     # model = "nomic-embed-text"
     # model = "bge-m3"
     # model = "qwen3-embedding"
     inputs = [tip + document_or_query for document_or_query in documents_or_queries]
+    payload = {"model": model, "input": inputs}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
     try:
-        with urllib.request.urlopen(
-            "http://localhost:11434/api/embed",
-            data=json.dumps({"model": model, "input": inputs}).encode("utf-8"),
-        ) as response:
+        with open_ollama("/api/embed", payload, timeouts) as response:
             status = response.status
-            answer = json.loads(response.read().decode("utf-8"))
-            embeddings = answer["embeddings"]
-    except HTTPError as e:
-        status = e.status
+            for answer in response:
+                embeddings = answer["embeddings"]
+                record_metrics("/api/embed", model, task, answer)
+    except OLLAMA_ERRORS as e:
+        status = getattr(e, "status", None)
         embeddings = None
     return {"type": "embeddings", "status": status, "data": embeddings}
 
 
-def generate_stream(prompt, model="qwen3"):
+def generate_stream(prompt, model="qwen3", timeouts=None, task=None, keep_alive=None):
     # model = "magistral"
     # model = "qwen3"
     # model = "gpt-oss"
+    payload = {"model": model, "prompt": prompt, "stream": True}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    status = None
     try:
-        with urllib.request.urlopen(
-            "http://localhost:11434/api/generate",
-            data=json.dumps({"model": model, "prompt": prompt, "stream": True}).encode(
-                "utf-8"
-            ),
-        ) as response:
+        with open_ollama("/api/generate", payload, timeouts) as response:
             status = response.status
-            for line in response:
-                answer = json.loads(line)
+            for answer in response:
                 if "thinking" in answer:
                     assert not answer["response"]
                     yield {
@@ -69,36 +535,245 @@ def generate_stream(prompt, model="qwen3"):
                         "status": status,
                         "data": answer["response"],
                     }
-    except HTTPError as e:
-        yield {"type": "error", "status": status, "data": None}
+                if answer.get("done"):
+                    yield {
+                        "type": "metrics",
+                        "status": status,
+                        "data": record_metrics("/api/generate", model, task, answer),
+                    }
+    except OLLAMA_ERRORS as e:
+        yield {"type": "error", "status": getattr(e, "status", status), "data": None}
 
 
-def generate(prompt, model="qwen3"):
+def generate(prompt, model="qwen3", timeouts=None, task=None, keep_alive=None):
     # model = "magistral"
     # model = "qwen3"
     # model = "gpt-oss"
+    payload = {"model": model, "prompt": prompt, "stream": False}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    status = None
     try:
-        with urllib.request.urlopen(
-            "http://localhost:11434/api/generate",
-            data=json.dumps({"model": model, "prompt": prompt, "stream": False}).encode(
-                "utf-8"
-            ),
-        ) as response:
+        with open_ollama("/api/generate", payload, timeouts) as response:
             status = response.status
             thinking = ""
             content = ""
-            for line in response:
-                answer = json.loads(line)
+            metrics = []
+            for answer in response:
                 if "thinking" in answer:
                     thinking += answer["thinking"]
                 if "response" in answer:
                     content += answer["response"]
-    except HTTPError as e:
-        return [{"status": status, "type": "error", "data": None}]
+                if answer.get("done"):
+                    metrics.append(record_metrics("/api/generate", model, task, answer))
+    except OLLAMA_ERRORS as e:
+        return [{"status": getattr(e, "status", status), "type": "error", "data": None}]
     return [
         {"type": "thinking", "status": status, "data": thinking},
         {"type": "content", "status": status, "data": content},
+    ] + [{"type": "metrics", "status": status, "data": data} for data in metrics]
+
+
+def get_model_name(name):
+    return name.removesuffix(":latest")
+
+
+def fetch_loaded_models(url, timeouts=HEALTH_TIMEOUTS):
+    # Talks to one endpoint directly, bypassing the pool, so health checks
+    # reach endpoints that the pool currently avoids.
+    try:
+        connection, _, response = connect_ollama(
+            url, "/api/ps", None, {**TIMEOUTS, **timeouts}
+        )
+        try:
+            answer = json.loads(response.read())
+        finally:
+            connection.close()
+    except OLLAMA_ERRORS:
+        return None
+    return {get_model_name(model["name"]): model for model in answer["models"]}
+
+
+def get_loaded_models():
+    return {
+        endpoint.url: fetch_loaded_models(endpoint.url)
+        for endpoint in OLLAMA_POOL.endpoints
+    }
+
+
+def preload_model(model, keep_alive="30m", timeouts=None):
+    # An empty generate request only loads the model. Embedding models reject
+    # generate requests and are loaded by an empty embed request instead.
+    for endpoint, payload in [
+        ("/api/generate", {"model": model, "keep_alive": keep_alive}),
+        ("/api/embed", {"model": model, "input": [], "keep_alive": keep_alive}),
+    ]:
+        # Timed on the client, a load request may answer with an empty body
+        # and without load_duration.
+        start = time.perf_counter()
+        try:
+            with open_ollama(endpoint, payload, timeouts) as response:
+                for answer in response:
+                    record_metrics(endpoint, model, "warmup", answer)
+            return time.perf_counter() - start
+        except HTTPError as e:
+            if e.status != 400:
+                return None
+        except OLLAMA_ERRORS:
+            return None
+    return None
+
+
+def unload_model(model, timeouts=None):
+    return preload_model(model, keep_alive=0, timeouts=timeouts) is not None
+
+
+def warmup(models, keep_alive="30m"):
+    load_seconds = {}
+    for model in models:
+        load_seconds[model] = preload_model(model, keep_alive)
+        print("warmup", model, load_seconds[model])
+    return load_seconds
+
+
+def get_tool_name(tool):
+    return tool["description"]["function"]["name"]
+
+
+def get_tool_executor(tool):
+    # Each tool gets its own pool sized to its max_concurrency, so a saturated
+    # tool queues only its own calls. Keyed on the limit as well, in case
+    # another tools list declares the same name with a different one.
+    key = (get_tool_name(tool), tool.get("max_concurrency", TOOL_WORKERS))
+    with TOOL_LOCK:
+        if key not in TOOL_EXECUTORS:
+            TOOL_EXECUTORS[key] = concurrent.futures.ThreadPoolExecutor(key[1])
+        return TOOL_EXECUTORS[key]
+
+
+def run_tool_calls(tool_calls, tools):
+    # All calls of one model turn run concurrently, each tool limited to its
+    # max_concurrency and timeout, and the results come back in call order.
+    handlers = {get_tool_name(tool): tool for tool in tools or []}
+    start = time.monotonic()
+    futures = []
+    for tool_call in tool_calls:
+        tool = handlers.get(tool_call["function"]["name"])
+        if tool is not None:
+            future = get_tool_executor(tool).submit(tool["handler"], tool_call)
+        else:
+            future = None
+        futures.append((tool_call, tool, future))
+    results = []
+    for tool_call, tool, future in futures:
+        if future is None:
+            # The model still needs an answer for every call it made.
+            results.append((tool_call, {"error": "unknown tool"}))
+            continue
+        timeout = tool.get("timeout", TOOL_TIMEOUT)
+        try:
+            tool_return = future.result(max(start + timeout - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            # The handler keeps running in its thread, the model is told to do
+            # without its result.
+            tool_return = {"error": f"{get_tool_name(tool)} timed out after {timeout}s"}
+        except (KeyError, TypeError, ValueError, RuntimeError, OSError) as error:
+            # Missing or malformed arguments from the model and failed calls to
+            # the services behind the tools.
+            tool_return = {"error": f"{type(error).__name__}: {error}"}
+        results.append((tool_call, tool_return))
+    return results
+
+
+def estimate_tokens(message):
+    return len(json.dumps(message, ensure_ascii=False)) // CHARS_PER_TOKEN
+
+
+def truncate_content(content, length):
+    if len(content) <= length or content.startswith("[truncated "):
+        return content
+    return (
+        f"[truncated {len(content) - length} of {len(content)} characters] "
+        + (content[:length])
+    )
+
+
+def truncate_values(value, length):
+    if isinstance(value, str):
+        return truncate_content(value, length)
+    if isinstance(value, list):
+        return [truncate_values(item, length) for item in value]
+    if isinstance(value, dict):
+        return {key: truncate_values(item, length) for key, item in value.items()}
+    return value
+
+
+def dump_truncated(value, length):
+    # The strings inside are shortened rather than the serialized text, so the
+    # model still gets valid JSON with all keys. The per string limit halves
+    # until the whole fits or the strings are down to a few characters.
+    content = json.dumps(value)
+    limit = length
+    while len(content) > length and limit > 16:
+        limit //= 2
+        content = json.dumps(truncate_values(value, limit))
+    return content
+
+
+def make_tool_message(tool_call, tool_return, context_budget):
+    if context_budget:
+        # No single tool result may take more than a quarter of the budget.
+        content = dump_truncated(tool_return, context_budget * CHARS_PER_TOKEN // 4)
+    else:
+        content = json.dumps(tool_return)
+    return {"role": "tool", "tool_call_id": tool_call["id"], "content": content}
+
+
+def compact_message(message):
+    content = message.get("content") or ""
+    if message["role"] == "tool":
+        try:
+            return {
+                **message,
+                "content": dump_truncated(json.loads(content), COMPACTED_LENGTH),
+            }
+        except ValueError:
+            pass
+    return {**message, "content": truncate_content(content, COMPACTED_LENGTH)}
+
+
+def compact_messages(messages, context_budget, keep_recent=2):
+    # Returns the history to send, with old tool results and assistant answers
+    # truncated, oldest first, until it is back at three quarters of the
+    # budget. The caller's messages stay whole. The system prompt and the first
+    # user message are never touched and truncation is deterministic, so
+    # Ollama's prompt cache keeps matching the history up to the oldest message
+    # compacted last time.
+    if not context_budget:
+        return messages
+    sizes = [estimate_tokens(message) for message in messages]
+    total = sum(sizes)
+    if total <= context_budget:
+        return messages
+    target = context_budget * 3 // 4
+    users = [
+        index for index, message in enumerate(messages) if message["role"] == "user"
+    ]
+    tools = [
+        index for index, message in enumerate(messages) if message["role"] == "tool"
     ]
+    recent = set(tools[-keep_recent:]) if keep_recent else set()
+    first = users[0] + 1 if users else 0
+    compacted = list(messages)
+    for index in range(first, len(messages) - 1):
+        if total <= target:
+            break
+        message = messages[index]
+        if index in recent or message["role"] not in ["tool", "assistant"]:
+            continue
+        compacted[index] = compact_message(message)
+        total += estimate_tokens(compacted[index]) - sizes[index]
+    return compacted
 
 
 def assemble_messages(system_prompt, user_prompt):
@@ -120,7 +795,21 @@ def assemble_messages(system_prompt, user_prompt):
     return messages
 
 
-def chat_stream(messages, model="qwen3", think=None, format=None, tools=None):
+def chat_stream(
+    messages,
+    model="qwen3",
+    think=None,
+    format=None,
+    tools=None,
+    timeouts=None,
+    options=None,
+    cache=None,
+    think_budget=None,
+    task=None,
+    keep_alive=None,
+    context_budget=None,
+    retry_without_thinking=True,
+):
     # model = "magistral"
     # model = "qwen3"
     # model = "gpt-oss"
@@ -130,36 +819,94 @@ def chat_stream(messages, model="qwen3", think=None, format=None, tools=None):
             "messages": messages,
             "stream": True,
         }
-        if think:
+        if think is not None:
             payload["think"] = think
         if format:
             payload["format"] = format
+        if options:
+            payload["options"] = options
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
         if tools:
             payload["tools"] = [tool["description"] for tool in tools]
+        key = None
+        if cache is not None and not tools and is_deterministic(options):
+            key = get_cache_key(payload)
+            cached = cache.get(key)
+            if cached is not None:
+                payload["messages"].append(
+                    {"role": "assistant", "content": cached["content"]}
+                )
+                if cached["thinking"]:
+                    yield {
+                        "type": "thinking",
+                        "status": 200,
+                        "data": cached["thinking"],
+                    }
+                yield {"type": "content", "status": 200, "data": cached["content"]}
+                return
         pending = False
         status = None
+        thinking = ""
+        thinking_tokens = 0
+        content = ""
         done = False
         while pending or not done:
-            with urllib.request.urlopen(
-                "http://localhost:11434/api/chat",
-                data=json.dumps(payload).encode("utf-8"),
-            ) as response:
+            request = {
+                **payload,
+                "messages": compact_messages(payload["messages"], context_budget),
+            }
+            with open_ollama("/api/chat", request, timeouts) as response:
                 pending = False
                 status = response.status
                 event_type = None
-                for line in response:
-                    answer = json.loads(line)
+                for answer in response:
                     message = answer["message"]
                     done = answer["done"]
                     # if done:
                     #    print(answer)
                     if "thinking" in message:
                         assert not done and not message["content"]
+                        thinking_tokens += 1
+                        if think_budget is not None and thinking_tokens > think_budget:
+                            # Ollama streams one token per thinking chunk. Closing
+                            # the connection cancels the generation, the retry
+                            # answers without thinking.
+                            yield {
+                                "type": "budget_exceeded",
+                                "status": status,
+                                "data": thinking_tokens,
+                            }
+                            if not retry_without_thinking:
+                                return
+                            payload["think"] = False
+                            thinking = ""
+                            pending = True
+                            # The retried answer belongs to the request
+                            # without thinking and is cached under its key.
+                            if key is not None:
+                                key = get_cache_key(payload)
+                                cached = cache.get(key)
+                                if cached is not None:
+                                    payload["messages"].append(
+                                        {
+                                            "role": "assistant",
+                                            "content": cached["content"],
+                                        }
+                                    )
+                                    yield {
+                                        "type": "content",
+                                        "status": 200,
+                                        "data": cached["content"],
+                                    }
+                                    return
+                            break
                         # if event_type != "thinking":
                         #     payload["messages"].append(message)
                         #     event_type = "thinking"
                         # else:
                         #     payload["messages"][-1]["thinking"] += message["thinking"]
+                        thinking += message["thinking"]
                         yield {
                             "type": "thinking",
                             "status": status,
@@ -172,6 +919,7 @@ def chat_stream(messages, model="qwen3", think=None, format=None, tools=None):
                             event_type = "content"
                         else:
                             payload["messages"][-1]["content"] += message["content"]
+                        content += message["content"]
                         yield {
                             "type": "content",
                             "status": status,
@@ -180,43 +928,59 @@ def chat_stream(messages, model="qwen3", think=None, format=None, tools=None):
                     if "tool_calls" in message:
                         # assert not done
                         if event_type != "tooling":
-                            payload["messages"].append(message)
+                            # Tool call messages carry an empty content and are
+                            # already in the history as the last message.
+                            if payload["messages"][-1] is not message:
+                                payload["messages"].append(message)
                             event_type = "tooling"
                         else:
                             payload["messages"][-1]["tool_calls"].append(
                                 message["tool_calls"]
                             )
                         tooling = []
-                        for tool_call in message["tool_calls"]:
-                            for tool in tools:
-                                if (
-                                    tool_call["function"]["name"]
-                                    == tool["description"]["function"]["name"]
-                                ):
-                                    tool_return = tool["handler"](tool_call)
-                                    tooling.append(
-                                        {"call": tool_call, "return": tool_return}
-                                    )
-                                    payload["messages"].append(
-                                        {
-                                            "role": "tool",
-                                            "tool_call_id": tool_call["id"],
-                                            "content": json.dumps(tool_return),
-                                        }
-                                    )
-                                    pending = True
-                                    break
+                        for tool_call, tool_return in run_tool_calls(
+                            message["tool_calls"], tools
+                        ):
+                            tooling.append({"call": tool_call, "return": tool_return})
+                            payload["messages"].append(
+                                make_tool_message(
+                                    tool_call, tool_return, context_budget
+                                )
+                            )
+                            pending = True
                         yield {
                             "type": "tooling",
                             "status": status,
                             "data": json.dumps(tooling),
                         }
-    except HTTPError as e:
-        print("HTTPError", e)
-        yield {"type": "error", "status": status, "data": None}
+                    if done:
+                        yield {
+                            "type": "metrics",
+                            "status": status,
+                            "data": record_metrics(
+                                "/api/chat", model, task, answer, format
+                            ),
+                        }
+        if key is not None:
+            cache.put(key, {"thinking": thinking, "content": content})
+    except OLLAMA_ERRORS as e:
+        print(type(e).__name__, e)
+        yield {"type": "error", "status": getattr(e, "status", status), "data": None}
 
 
-def chat(messages, model="qwen3", think=None, format=None, tools=None):
+def chat(
+    messages,
+    model="qwen3",
+    think=None,
+    format=None,
+    tools=None,
+    timeouts=None,
+    options=None,
+    cache=None,
+    task=None,
+    keep_alive=None,
+    context_budget=None,
+):
     # model = "magistral"
     # model = "qwen3"
     # model = "gpt-oss"
@@ -226,72 +990,113 @@ def chat(messages, model="qwen3", think=None, format=None, tools=None):
             "messages": messages,
             "stream": False,
         }
-        if think:
+        if think is not None:
             payload["think"] = think
         if format:
             payload["format"] = format
+        if options:
+            payload["options"] = options
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
         if tools:
             payload["tools"] = [tool["description"] for tool in tools]
+        key = None
+        if cache is not None and not tools and is_deterministic(options):
+            key = get_cache_key(payload)
+            cached = cache.get(key)
+            if cached is not None:
+                payload["messages"].append(
+                    {"role": "assistant", "content": cached["content"]}
+                )
+                return [
+                    {"type": "thinking", "status": 200, "data": cached["thinking"]},
+                    {"type": "tooling", "status": 200, "data": "[]"},
+                    {"type": "content", "status": 200, "data": cached["content"]},
+                ]
         pending = False
         status = None
         thinking = ""
         content = ""
         tooling = []
+        metrics = []
         done = False
         while pending or not done:
-            with urllib.request.urlopen(
-                "http://localhost:11434/api/chat",
-                data=json.dumps(payload).encode("utf-8"),
-            ) as response:
+            request = {
+                **payload,
+                "messages": compact_messages(payload["messages"], context_budget),
+            }
+            with open_ollama("/api/chat", request, timeouts) as response:
                 pending = False
                 status = response.status
-                for line in response:
-                    answer = json.loads(line)
+                for answer in response:
                     message = answer["message"]
                     done = answer["done"]
-                    payload["messages"].append(message)
+                    # Thinking is only of use for the answer it led to, sending
+                    # it back would just grow the prompt.
+                    payload["messages"].append(
+                        {
+                            key: value
+                            for key, value in message.items()
+                            if key != "thinking"
+                        }
+                    )
+                    if done:
+                        metrics.append(
+                            record_metrics("/api/chat", model, task, answer, format)
+                        )
                     if "thinking" in message:
                         thinking += message["thinking"]
                     if "content" in message:
                         content += message["content"]
                     if "tool_calls" in message:
-                        for tool_call in message["tool_calls"]:
-                            for tool in tools:
-                                if (
-                                    tool_call["function"]["name"]
-                                    == tool["description"]["function"]["name"]
-                                ):
-                                    tool_return = tool["handler"](tool_call)
-                                    tooling.append(
-                                        {
-                                            "call": tool_call,
-                                            "return": tool_return,
-                                        }
-                                    )
-                                    payload["messages"].append(
-                                        {
-                                            "role": "tool",
-                                            "tool_call_id": tool_call["id"],
-                                            "content": json.dumps(tool_return),
-                                        }
-                                    )
-                                    pending = True
-                                    break
-    except HTTPError as e:
-        return [{"status": status, "type": "error", "data": None}]
+                        for tool_call, tool_return in run_tool_calls(
+                            message["tool_calls"], tools
+                        ):
+                            tooling.append({"call": tool_call, "return": tool_return})
+                            payload["messages"].append(
+                                make_tool_message(
+                                    tool_call, tool_return, context_budget
+                                )
+                            )
+                            pending = True
+        if key is not None:
+            cache.put(key, {"thinking": thinking, "content": content})
+    except OLLAMA_ERRORS as e:
+        return [{"status": getattr(e, "status", status), "type": "error", "data": None}]
     return [
         {"type": "thinking", "status": status, "data": thinking},
         {"type": "tooling", "status": status, "data": json.dumps(tooling)},
         {"type": "content", "status": status, "data": content},
-    ]
+    ] + [{"type": "metrics", "status": status, "data": data} for data in metrics]
 
 
-def run_chat(user_prompt, model, think, format, debug):
+def run_chat(
+    user_prompt,
+    model,
+    think,
+    format,
+    debug,
+    timeouts=None,
+    options=None,
+    cache=None,
+    task=None,
+    keep_alive=None,
+):
     if debug:
         print(user_prompt)
     messages = assemble_messages(None, user_prompt)
     content = ""
-    for event in chat(messages, model=model, think=think, format=format):
+    for event in chat(
+        messages,
+        model=model,
+        think=think,
+        format=format,
+        timeouts=timeouts,
+        options=options,
+        cache=cache,
+        task=task,
+        keep_alive=keep_alive,
+    ):
         assert event["status"] == 200
         if event["type"] == "content":
             content += event["data"]
@@ -300,14 +1105,43 @@ def run_chat(user_prompt, model, think, format, debug):
     return content
 
 
-def run_chat_stream(user_prompt, model, think, format, debug):
+def run_chat_stream(
+    user_prompt,
+    model,
+    think,
+    format,
+    debug,
+    timeouts=None,
+    options=None,
+    cache=None,
+    think_budget=None,
+    task=None,
+    keep_alive=None,
+    retry_without_thinking=True,
+):
+    # Returns None when the thinking budget ran out and retrying without
+    # thinking was not wanted.
     if debug:
         print(user_prompt)
     messages = assemble_messages(None, user_prompt)
     event_type = None
     content = ""
-    for event in chat_stream(messages, model=model, think=think, format=format):
+    for event in chat_stream(
+        messages,
+        model=model,
+        think=think,
+        format=format,
+        timeouts=timeouts,
+        options=options,
+        cache=cache,
+        think_budget=think_budget,
+        task=task,
+        keep_alive=keep_alive,
+        retry_without_thinking=retry_without_thinking,
+    ):
         assert event["status"] == 200
+        if event["type"] == "budget_exceeded" and not retry_without_thinking:
+            return None
         if event["type"] != event_type:
             if debug:
                 print(f"{event['type']} ", end="")
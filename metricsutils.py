@@ -0,0 +1,128 @@
+import json
+import os
+import sys
+
+from llmutils import METRIC_FIELDS, METRICS_PATH
+
+# Ollama reports a few milliseconds of load_duration for a resident model, a
+# load from disk takes seconds.
+RELOAD_SECONDS = 0.5
+
+
+def load_metrics(path=METRICS_PATH):
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def aggregate_metrics(records):
+    aggregates = {}
+    for record in records:
+        key = (
+            record["model"],
+            record["task"] or "default",
+            record.get("format") or "none",
+        )
+        aggregate = aggregates.setdefault(
+            key, {"calls": 0, "reloads": 0, **{field: 0 for field in METRIC_FIELDS}}
+        )
+        aggregate["calls"] += 1
+        aggregate["reloads"] += (
+            record.get("load_duration") or 0
+        ) > RELOAD_SECONDS * 1e9
+        for field in METRIC_FIELDS:
+            aggregate[field] += record.get(field) or 0
+    for aggregate in aggregates.values():
+        eval_seconds = aggregate["eval_duration"] / 1e9
+        prompt_eval_seconds = aggregate["prompt_eval_duration"] / 1e9
+        aggregate["tokens_per_second"] = (
+            aggregate["eval_count"] / eval_seconds if eval_seconds else 0.0
+        )
+        aggregate["prompt_tokens_per_second"] = (
+            aggregate["prompt_eval_count"] / prompt_eval_seconds
+            if prompt_eval_seconds
+            else 0.0
+        )
+        aggregate["load_seconds"] = aggregate["load_duration"] / 1e9
+        aggregate["prompt_eval_share"] = (
+            aggregate["prompt_eval_duration"] / aggregate["total_duration"]
+            if aggregate["total_duration"]
+            else 0.0
+        )
+    return aggregates
+
+
+PROMETHEUS_METRICS = [
+    ("ollama_calls_total", "calls", 1, "Ollama calls"),
+    ("ollama_reloads_total", "reloads", 1, "Calls that had to load their model"),
+    (
+        "ollama_duration_seconds_total",
+        "total_duration",
+        1e9,
+        "Wall time spent in Ollama",
+    ),
+    (
+        "ollama_load_duration_seconds_total",
+        "load_duration",
+        1e9,
+        "Time spent loading models",
+    ),
+    (
+        "ollama_prompt_eval_tokens_total",
+        "prompt_eval_count",
+        1,
+        "Prompt tokens evaluated",
+    ),
+    (
+        "ollama_prompt_eval_duration_seconds_total",
+        "prompt_eval_duration",
+        1e9,
+        "Time spent evaluating prompts",
+    ),
+    ("ollama_eval_tokens_total", "eval_count", 1, "Tokens generated"),
+    (
+        "ollama_eval_duration_seconds_total",
+        "eval_duration",
+        1e9,
+        "Time spent generating tokens",
+    ),
+]
+
+
+def format_prometheus(aggregates):
+    lines = []
+    for name, field, scale, description in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {name} {description}.")
+        lines.append(f"# TYPE {name} counter")
+        for (model, task, format), aggregate in sorted(aggregates.items()):
+            labels = f'model="{model}",task="{task}",format="{format}"'
+            lines.append(f"{name}{{{labels}}} {aggregate[field] / scale:g}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(aggregates, path="data/ollama_metrics.prom"):
+    # Written to a temporary file first so a node exporter textfile collector
+    # never reads a partial file.
+    with open(path + ".tmp", "w") as file:
+        file.write(format_prometheus(aggregates))
+    os.replace(path + ".tmp", path)
+
+
+def report_metrics(aggregates):
+    for (model, task, format), aggregate in sorted(aggregates.items()):
+        print(
+            f"{model} {task} {format}",
+            f"calls={aggregate['calls']}",
+            f"tokens/call={aggregate['eval_count'] / aggregate['calls']:.0f}",
+            f"tokens/s={aggregate['tokens_per_second']:.1f}",
+            f"prompt_tokens/s={aggregate['prompt_tokens_per_second']:.1f}",
+            f"reloads={aggregate['reloads']}",
+            f"load={aggregate['load_seconds']:.1f}s",
+            f"prompt_eval_share={aggregate['prompt_eval_share']:.1%}",
+        )
+
+
+if __name__ == "__main__":
+    aggregates = aggregate_metrics(load_metrics())
+    report_metrics(aggregates)
+    if "prometheus" in sys.argv[1:]:
+        write_prometheus(aggregates)
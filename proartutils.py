@@ -1,8 +1,172 @@
 import concurrent.futures
 import json
+import statistics
+import time
 from dbutils import load_projects, load_pages, store_page
 from llmutils import embed_one, run_chat, run_chat_stream, load_json_response
 
+QUALITY_RATINGS_DE = ["ausgezeichnet", "gut", "ausreichend", "mangelhaft"]
+QUALITY_RATINGS_EN = ["excellent", "good", "adequate", "poor"]
+
+
+def make_classification_schema(product_categories):
+    return {
+        "type": "object",
+        "properties": {
+            "category": {"enum": product_categories + [None]},
+            "confidence": {"type": "number", "minimum": 0.0, "maximum": 1.0},
+            "reasoning": {"type": "string"},
+            "proposed_category": {"type": ["string", "null"]},
+        },
+        "required": ["category", "confidence", "reasoning", "proposed_category"],
+    }
+
+
+def make_rating_schema(quality_ratings):
+    strings = {"type": "array", "items": {"type": "string"}}
+    return {
+        "type": "object",
+        "properties": {
+            "completeness_score": {"type": "number", "minimum": 0.0, "maximum": 1.0},
+            "quality_rating": {"enum": quality_ratings},
+            "missing_critical_attributes": strings,
+            "missing_optional_attributes": strings,
+            "inconsistencies": strings,
+            "data_quality_issues": strings,
+            "reasoning": {"type": "string"},
+            "recommendations": strings,
+        },
+        "required": [
+            "completeness_score",
+            "quality_rating",
+            "missing_critical_attributes",
+            "missing_optional_attributes",
+            "inconsistencies",
+            "data_quality_issues",
+            "reasoning",
+            "recommendations",
+        ],
+    }
+
+
+def run_timed_chat(
+    prompt,
+    model,
+    think,
+    format,
+    debug,
+    options,
+    cache,
+    think_budget,
+    task,
+    retry_without_thinking=True,
+):
+    start = time.perf_counter()
+    response = run_chat_stream(
+        prompt,
+        model,
+        think,
+        format,
+        debug,
+        options=options,
+        cache=cache,
+        think_budget=think_budget,
+        task=task,
+        retry_without_thinking=retry_without_thinking,
+    )
+    return response, time.perf_counter() - start
+
+
+def route_chat(
+    prompt,
+    model,
+    think,
+    format,
+    evaluate,
+    is_valid,
+    debug,
+    options,
+    cache,
+    think_budget,
+    task,
+):
+    # With think="auto" every item is answered without thinking first and only
+    # re-run with thinking when that answer fails validation.
+    if think == "auto":
+        response, latency = run_timed_chat(
+            prompt, model, False, format, debug, options, cache, None, task
+        )
+        result = evaluate(response)
+        routing = {"route": "direct", "latency": latency, "thinking_latency": None}
+        if not is_valid(result):
+            # Retrying an overrun without thinking would only repeat the
+            # direct request, so its rejected result is kept instead.
+            response, thinking_latency = run_timed_chat(
+                prompt,
+                model,
+                True,
+                format,
+                debug,
+                options,
+                cache,
+                think_budget,
+                task,
+                retry_without_thinking=False,
+            )
+            if response is not None:
+                result = evaluate(response)
+            routing = {
+                "route": "escalated" if response is not None else "budget_exceeded",
+                "latency": latency + thinking_latency,
+                "thinking_latency": thinking_latency,
+            }
+    else:
+        response, latency = run_timed_chat(
+            prompt, model, think, format, debug, options, cache, think_budget, task
+        )
+        result = evaluate(response)
+        routing = {
+            "route": "thinking" if think else "direct",
+            "latency": latency,
+            "thinking_latency": latency if think else None,
+        }
+    routing["valid"] = is_valid(result)
+    result["routing"] = routing
+    return result
+
+
+def is_valid_rating(result):
+    return result.get("quality_rating") not in ["UNKNOWN", "UNBEKANNT"]
+
+
+def report_routing(results):
+    routings = [result["routing"] for result in results if "routing" in result]
+    thinking_latencies = [
+        routing["thinking_latency"]
+        for routing in routings
+        if routing["thinking_latency"] is not None
+    ]
+    direct_latencies = [
+        routing["latency"] for routing in routings if routing["route"] == "direct"
+    ]
+    routes = {}
+    for routing in routings:
+        routes[routing["route"]] = routes.get(routing["route"], 0) + 1
+    invalid = sum(not routing["valid"] for routing in routings)
+    print("routes", routes, f"invalid {invalid / max(len(routings), 1):.1%}")
+    if not thinking_latencies or not direct_latencies:
+        return
+    # Items answered directly are credited with the mean latency of the thinking
+    # runs that were observed.
+    thinking_latency = statistics.mean(thinking_latencies)
+    saved = [thinking_latency - latency for latency in direct_latencies]
+    print(
+        f"thinking {thinking_latency:.1f}s",
+        f"direct {statistics.mean(direct_latencies):.1f}s",
+        f"saved per direct item {statistics.mean(saved):.1f}s",
+        f"saved total {sum(saved):.1f}s",
+    )
+
 
 def assemble_classification_prompt_de(item):
     product_categories = [
@@ -153,16 +317,31 @@ def classify(
     model,
     think,
     debug=False,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
     classification = item.pop("klassifikation")
     rating_b2c = item.pop("bewertung_b2c")
     rating_b2b = item.pop("bewertung_b2b")
     product_categories, prompt = assemble_prompt(item)
-    response = run_chat_stream(prompt, model, think, "json", debug)
     item["klassifikation"] = classification
     item["bewertung_b2c"] = rating_b2c
     item["bewertung_b2b"] = rating_b2b
-    return evaluate_response(product_categories, response)
+    return route_chat(
+        prompt,
+        model,
+        think,
+        make_classification_schema(product_categories) if schema else "json",
+        lambda response: evaluate_response(product_categories, response),
+        lambda result: result.get("category") != "UNKNOWN",
+        debug,
+        options,
+        cache,
+        think_budget,
+        "classification",
+    )
 
 
 def assemble_b2c_rating_prompt_de(item):
@@ -295,18 +474,13 @@ Bitte beachte:
 Bewerte die folgende Produktbeschreibung:
 ```{json.dumps(item)}```
 """
-    return prompt
+    return QUALITY_RATINGS_DE, prompt
 
 
 def evaluate_b2c_rating_response_de(response):
     try:
         result = load_json_response(response)
-        if result.get("quality_rating") not in [
-            "ausgezeichnet",
-            "gut",
-            "ausreichend",
-            "mangelhaft",
-        ]:
+        if result.get("quality_rating") not in QUALITY_RATINGS_DE:
             return {
                 "completeness_score": 0.0,
                 "quality_rating": "UNBEKANNT",
@@ -462,18 +636,13 @@ Please note:
 Rate the following product description: 
 ```{json.dumps(item)}```
 """
-    return prompt
+    return QUALITY_RATINGS_EN, prompt
 
 
 def evaluate_b2c_rating_response_en(response):
     try:
         result = load_json_response(response)
-        if result.get("quality_rating") not in [
-            "excellent",
-            "good",
-            "adequate",
-            "poor",
-        ]:
+        if result.get("quality_rating") not in QUALITY_RATINGS_EN:
             return {
                 "completeness_score": 0.0,
                 "quality_rating": "UNKNOWN",
@@ -499,16 +668,38 @@ def evaluate_b2c_rating_error_en(error):
     }
 
 
-def rate_b2c(assemble_prompt, evaluate_response, item, model, think, debug=False):
+def rate_b2c(
+    assemble_prompt,
+    evaluate_response,
+    item,
+    model,
+    think,
+    debug=False,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
+):
     classification = item.pop("klassifikation")
     rating_b2c = item.pop("bewertung_b2c")
     rating_b2b = item.pop("bewertung_b2b")
-    prompt = assemble_prompt(item)
-    response = run_chat_stream(prompt, model, think, "json", debug)
+    quality_ratings, prompt = assemble_prompt(item)
     item["klassifikation"] = classification
     item["bewertung_b2c"] = rating_b2c
     item["bewertung_b2b"] = rating_b2b
-    return evaluate_response(response)
+    return route_chat(
+        prompt,
+        model,
+        think,
+        make_rating_schema(quality_ratings) if schema else "json",
+        evaluate_response,
+        is_valid_rating,
+        debug,
+        options,
+        cache,
+        think_budget,
+        "b2c",
+    )
 
 
 def assemble_b2b_rating_prompt_de(item):
@@ -563,18 +754,13 @@ Bitte beachte:
 Bewerte die folgende Produktbeschreibung:
 ```{json.dumps(item)}```
 """
-    return prompt
+    return QUALITY_RATINGS_DE, prompt
 
 
 def evaluate_b2b_rating_response_de(response):
     try:
         result = load_json_response(response)
-        if result.get("quality_rating") not in [
-            "ausgezeichnet",
-            "gut",
-            "ausreichend",
-            "mangelhaft",
-        ]:
+        if result.get("quality_rating") not in QUALITY_RATINGS_DE:
             return {
                 "completeness_score": 0.0,
                 "quality_rating": "UNBEKANNT",
@@ -652,18 +838,13 @@ Please note:
 Rate the following product description: 
 ```{json.dumps(item)}```
 """
-    return prompt
+    return QUALITY_RATINGS_EN, prompt
 
 
 def evaluate_b2b_rating_response_en(response):
     try:
         result = load_json_response(response)
-        if result.get("quality_rating") not in [
-            "excellent",
-            "good",
-            "adequate",
-            "poor",
-        ]:
+        if result.get("quality_rating") not in QUALITY_RATINGS_EN:
             return {
                 "completeness_score": 0.0,
                 "quality_rating": "UNKNOWN",
@@ -689,16 +870,46 @@ def evaluate_b2b_rating_error_en(error):
     }
 
 
-def rate_b2b(assemble_prompt, evaluate_response, item, model, think, debug=False):
+def rate_b2b(
+    assemble_prompt,
+    evaluate_response,
+    item,
+    model,
+    think,
+    debug=False,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
+):
     classification = item.pop("klassifikation")
     rating_b2c = item.pop("bewertung_b2c")
     rating_b2b = item.pop("bewertung_b2b")
-    prompt = assemble_prompt(item)
-    response = run_chat_stream(prompt, model, think, "json", debug)
+    quality_ratings, prompt = assemble_prompt(item)
     item["klassifikation"] = classification
     item["bewertung_b2c"] = rating_b2c
     item["bewertung_b2b"] = rating_b2b
-    return evaluate_response(response)
+    return route_chat(
+        prompt,
+        model,
+        think,
+        make_rating_schema(quality_ratings) if schema else "json",
+        evaluate_response,
+        is_valid_rating,
+        debug,
+        options,
+        cache,
+        think_budget,
+        "b2b",
+    )
+
+
+def get_repetition_options(options, repetition):
+    # Give each repetition of a seeded run its own seed, so the three answers
+    # per item stay distinct samples while remaining reproducible and cacheable.
+    if options and "seed" in options:
+        return {**options, "seed": options["seed"] + repetition}
+    return options
 
 
 def prepare(item, model):
@@ -735,11 +946,16 @@ def classify_serial(
     items,
     model,
     think,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     for item in items:
         item = prepare(item, model)
         if item:
-            for _ in range(3):
+            for repetition in range(3):
                 classification = classify(
                     assemble_prompt,
                     evaluate_response,
@@ -747,10 +963,16 @@ def classify_serial(
                     model,
                     think,
                     debug=True,
+                    options=get_repetition_options(options, repetition),
+                    cache=cache,
+                    think_budget=think_budget,
+                    schema=schema,
                 )
+                results.append(classification)
                 follow_up(
                     connection, project, item, model, "klassifikation", classification
                 )
+    report_routing(results)
 
 
 def classify_parallel(
@@ -763,13 +985,18 @@ def classify_parallel(
     model,
     think,
     max_workers=4,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
         futures = {}
         for item in items:
             item = prepare(item, model)
             if item:
-                for _ in range(3):
+                for repetition in range(3):
                     futures[
                         executor.submit(
                             classify,
@@ -778,6 +1005,10 @@ def classify_parallel(
                             item,
                             model,
                             think,
+                            options=get_repetition_options(options, repetition),
+                            cache=cache,
+                            think_budget=think_budget,
+                            schema=schema,
                         )
                     ] = item
         for future in concurrent.futures.as_completed(futures):
@@ -786,18 +1017,31 @@ def classify_parallel(
                 classification = future.result()
             except Exception as error:
                 classification = evaluate_error(error)
+            results.append(classification)
             follow_up(
                 connection, project, item, model, "klassifikation", classification
             )
+    report_routing(results)
 
 
 def rate_b2c_serial(
-    assemble_prompt, evaluate_response, connection, project, items, model, think
+    assemble_prompt,
+    evaluate_response,
+    connection,
+    project,
+    items,
+    model,
+    think,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     for item in items:
         item = prepare(item, model)
         if item:
-            for _ in range(3):
+            for repetition in range(3):
                 rating = rate_b2c(
                     assemble_prompt,
                     evaluate_response,
@@ -805,8 +1049,14 @@ def rate_b2c_serial(
                     model,
                     think,
                     debug=True,
+                    options=get_repetition_options(options, repetition),
+                    cache=cache,
+                    think_budget=think_budget,
+                    schema=schema,
                 )
+                results.append(rating)
                 follow_up(connection, project, item, model, "bewertung_b2c", rating)
+    report_routing(results)
 
 
 def rate_b2c_parallel(
@@ -819,13 +1069,18 @@ def rate_b2c_parallel(
     model,
     think,
     max_workers=4,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
         futures = {}
         for item in items:
             item = prepare(item, model)
             if item:
-                for _ in range(3):
+                for repetition in range(3):
                     futures[
                         executor.submit(
                             rate_b2c,
@@ -834,6 +1089,10 @@ def rate_b2c_parallel(
                             item,
                             model,
                             think,
+                            options=get_repetition_options(options, repetition),
+                            cache=cache,
+                            think_budget=think_budget,
+                            schema=schema,
                         )
                     ] = item
         for future in concurrent.futures.as_completed(futures):
@@ -842,25 +1101,44 @@ def rate_b2c_parallel(
                 rating = future.result()
             except Exception as error:
                 rating = evaluate_error(error)
+            results.append(rating)
             follow_up(connection, project, item, model, "bewertung_b2c", rating)
+    report_routing(results)
 
 
 def rate_b2b_serial(
-    assemble_prompt, evaluate_response, connection, project, items, model, think
+    assemble_prompt,
+    evaluate_response,
+    connection,
+    project,
+    items,
+    model,
+    think,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     for item in items:
         item = prepare(item, model)
         if item:
-            for _ in range(3):
-                rating = rate_b2c(
+            for repetition in range(3):
+                rating = rate_b2b(
                     assemble_prompt,
                     evaluate_response,
                     item,
                     model,
                     think,
                     debug=True,
+                    options=get_repetition_options(options, repetition),
+                    cache=cache,
+                    think_budget=think_budget,
+                    schema=schema,
                 )
+                results.append(rating)
                 follow_up(connection, project, item, model, "bewertung_b2b", rating)
+    report_routing(results)
 
 
 def rate_b2b_parallel(
@@ -873,13 +1151,18 @@ def rate_b2b_parallel(
     model,
     think,
     max_workers=4,
+    options=None,
+    cache=None,
+    think_budget=None,
+    schema=True,
 ):
+    results = []
     with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
         futures = {}
         for item in items:
             item = prepare(item, model)
             if item:
-                for _ in range(3):
+                for repetition in range(3):
                     futures[
                         executor.submit(
                             rate_b2b,
@@ -888,6 +1171,10 @@ def rate_b2b_parallel(
                             item,
                             model,
                             think,
+                            options=get_repetition_options(options, repetition),
+                            cache=cache,
+                            think_budget=think_budget,
+                            schema=schema,
                         )
                     ] = item
         for future in concurrent.futures.as_completed(futures):
@@ -896,4 +1183,6 @@ def rate_b2b_parallel(
                 rating = future.result()
             except Exception as error:
                 rating = evaluate_error(error)
+            results.append(rating)
             follow_up(connection, project, item, model, "bewertung_b2b", rating)
+    report_routing(results)
@@ -3,6 +3,8 @@ from dbutils import (
     load_wikipedia_pageviews,
     scrape_wikipedia_pages,
     extract_wikipedia_sections,
+    build_title_index,
+    optimize_fts_indexes,
     load_faiss,
     query_faiss,
     query_fts,
@@ -12,7 +14,7 @@ from llmutils import generate, generate_stream
 
 def run_generate(prompt):
     print(prompt)
-    for event in generate(prompt):
+    for event in generate(prompt, task="rag"):
         assert event["status"] == 200
         print(event["type"], event["data"])
 
@@ -20,7 +22,7 @@ def run_generate(prompt):
 def run_generate_stream(prompt):
     print(prompt)
     event_type = None
-    for event in generate_stream(prompt):
+    for event in generate_stream(prompt, task="rag"):
         assert event["status"] == 200
         if event["type"] != event_type:
             print(f"{event['type']} ", end="")
@@ -36,6 +38,17 @@ if __name__ == "__main__":
         scrape_wikipedia_pages(100)
     if "extract_wikipedia_sections" in sys.argv[1:]:
         extract_wikipedia_sections()
+    if "build_title_index" in sys.argv[1:]:
+        build_title_index()
+    if {
+        "load_wikipedia_pageviews",
+        "extract_wikipedia_sections",
+        "build_title_index",
+        "optimize_fts",
+    } & set(sys.argv[1:]):
+        before, after = optimize_fts_indexes()
+        for table in before:
+            print(table, before[table], "->", after[table])
     for basic_prompt in [
         "Tell me about Google Chrome."
         # "What year was the Berlin Wall built, and which countries were involved in its construction?",
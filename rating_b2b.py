@@ -1,6 +1,7 @@
 import json
 import sqlite3
 from dbutils import load_projects, load_pages, store_page
+from llmutils import ResponseCache, warmup
 from proartutils import (
     assemble_b2b_rating_prompt_en,
     evaluate_b2b_rating_response_en,
@@ -20,7 +21,18 @@ if __name__ == "__main__":
     # model = "magistral"
     # model = "deepseek-r1"
     model = "qwen3"
-    think = True
+    # think = True
+    # Answer directly first and think only when the answer fails validation,
+    # cutting thinking off after think_budget tokens.
+    think = "auto"
+    think_budget = 1_000
+    # Seeded requests are answered from the response cache on re-runs, drop the
+    # seed or the cache for fresh sampling runs.
+    options = {"seed": 0}
+    cache = ResponseCache("data/llm_cache.db")
+    # options = None
+    # cache = None
+    warmup([model])
     with sqlite3.connect("data/rag.db") as connection:
         projects = load_projects(connection)
         items = [
@@ -35,6 +47,9 @@ if __name__ == "__main__":
             items,
             model,
             think,
+            options=options,
+            cache=cache,
+            think_budget=think_budget,
         )
         """
         rate_b2b_parallel(
@@ -46,4 +61,7 @@ if __name__ == "__main__":
             items,
             model,
             think,
+            options=options,
+            cache=cache,
+            think_budget=think_budget,
         )
@@ -0,0 +1,526 @@
+import collections
+import concurrent.futures
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dbutils import (
+    EMBEDDING_KEEP_ALIVE,
+    FTS_TABLES,
+    RESULT_CACHE,
+    check_faiss_consistency,
+    delete_wikipedia_page,
+    get_chunk,
+    index_wikipedia_pages,
+    load_faiss,
+    migrate_fts_triggers,
+    prepare_wikipedia_pages,
+    query_faiss_filtered,
+    query_faiss_many,
+    query_fts,
+    query_fts_snippets,
+    query_hybrid,
+    reextract_wikipedia_page,
+    save_faiss_shards,
+    search_wikipedia_term,
+)
+from ftsutils import maintain_fts
+from llmutils import preload_model
+
+
+class QueryBatcher:
+    def __init__(self, get_index, lock, max_batch_size=32, max_wait=0.005):
+        self.get_index = get_index
+        self.lock = lock
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def query(self, prompt, k, diversify=False):
+        future = concurrent.futures.Future()
+        self.requests.put((prompt, (k, diversify), future))
+        return future.result()
+
+    def collect(self):
+        requests = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def run(self):
+        while True:
+            requests = self.collect()
+            batches = {}
+            for request in requests:
+                batches.setdefault(request[1], []).append(request)
+            for (k, diversify), batch in batches.items():
+                try:
+                    texts = query_faiss_many(
+                        self.get_index(),
+                        [prompt for prompt, _, _ in batch],
+                        k=k,
+                        diversify=diversify,
+                        lock=self.lock,
+                    )
+                    for (_, _, future), result in zip(batch, texts):
+                        future.set_result(result)
+                # Any error belongs to the waiting callers, the batcher thread
+                # has to keep running.
+                except Exception as error:
+                    for _, _, future in batch:
+                        future.set_exception(error)
+
+
+class IngestionJobs:
+    def __init__(self, get_index, lock, max_workers=1, max_jobs=1_000, max_wait=60.0):
+        self.get_index = get_index
+        self.lock = lock
+        # Serializes ingestion, fetching and embedding run outside the index lock.
+        self.ingest_lock = threading.Lock()
+        self.max_jobs = max_jobs
+        self.max_wait = max_wait
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.jobs = {}
+        self.futures = {}
+        # Job id of every queued or running page.
+        self.pending = {}
+        self.jobs_lock = threading.Lock()
+
+    def ingest(self, project_name, page_names):
+        with self.ingest_lock:
+            statuses, page_ids = prepare_wikipedia_pages(project_name, page_names)
+            index = self.get_index()
+            with self.lock:
+                index_wikipedia_pages(index, page_ids)
+        return statuses
+
+    def submit(self, project_name, page_names, prefetch=False):
+        with self.jobs_lock:
+            job_ids = {
+                self.pending.get((project_name, page_name)) for page_name in page_names
+            }
+            if len(job_ids) == 1 and None not in job_ids:
+                # Already queued or running, e.g. by the prefetcher.
+                job = self.jobs[job_ids.pop()]
+                job["prefetch"] = job["prefetch"] and prefetch
+                return dict(job)
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "project_name": project_name,
+                "page_names": page_names,
+                "prefetch": prefetch,
+                "state": "queued",
+                "statuses": None,
+                "error": None,
+                "submitted": time.time(),
+                "finished": None,
+            }
+            self.evict()
+            self.jobs[job["job_id"]] = job
+            for page_name in page_names:
+                self.pending[(project_name, page_name)] = job["job_id"]
+            self.futures[job["job_id"]] = self.executor.submit(self.run, job)
+            return dict(job)
+
+    def evict(self):
+        # Forgets the oldest finished jobs, dicts keep their insertion order.
+        finished = [
+            job_id for job_id, job in self.jobs.items() if job["finished"] is not None
+        ]
+        for job_id in finished[: max(len(self.jobs) + 1 - self.max_jobs, 0)]:
+            del self.jobs[job_id]
+            del self.futures[job_id]
+
+    def finish(self, job, state):
+        with self.jobs_lock:
+            job["state"] = state
+            job["finished"] = time.time()
+            for page_name in job["page_names"]:
+                if self.pending.get((job["project_name"], page_name)) == job["job_id"]:
+                    del self.pending[(job["project_name"], page_name)]
+
+    def run(self, job):
+        job["state"] = "running"
+        try:
+            job["statuses"] = self.ingest(job["project_name"], job["page_names"])
+            self.finish(job, "done")
+        # Whatever fails, the job has to end up failed rather than running.
+        except Exception as error:
+            job["error"] = f"{type(error).__name__}: {error}"
+            self.finish(job, "failed")
+
+    def cancel(self, job_id):
+        # Only queued jobs can be cancelled, a running fetch is not interrupted.
+        with self.jobs_lock:
+            if job_id not in self.jobs:
+                raise ValueError(f"Unknown ingestion job {job_id}")
+            job, future = self.jobs[job_id], self.futures[job_id]
+        if future.cancel():
+            self.finish(job, "cancelled")
+        return dict(job)
+
+    def get_pending(self, project_name, page_name):
+        with self.jobs_lock:
+            return self.pending.get((project_name, page_name))
+
+    def get(self, job_id, wait=0.0, claim=True):
+        with self.jobs_lock:
+            if job_id not in self.jobs:
+                raise ValueError(f"Unknown ingestion job {job_id}")
+            job, future = self.jobs[job_id], self.futures[job_id]
+            if claim:
+                # Somebody waits for the job, so it is no longer speculative.
+                job["prefetch"] = False
+        if wait:
+            concurrent.futures.wait([future], timeout=min(wait, self.max_wait))
+        return dict(job)
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        ingestion,
+        max_pages=2,
+        min_views=10_000,
+        budget=30,
+        budget_seconds=3600.0,
+        supersede_seconds=30.0,
+    ):
+        self.ingestion = ingestion
+        self.max_pages = max_pages
+        self.min_views = min_views
+        # At most budget pages are prefetched per budget_seconds.
+        self.budget = budget
+        self.budget_seconds = budget_seconds
+        # Searches of the same turn run concurrently, so a search only cancels
+        # prefetches that are older than about one turn.
+        self.supersede_seconds = supersede_seconds
+        self.prefetched = collections.deque()
+        self.stats = {"searches": 0, "pages": 0, "cancelled": 0, "over_budget": 0}
+        self.lock = threading.Lock()
+
+    def get_budget_left(self):
+        while (
+            self.prefetched
+            and time.monotonic() - self.prefetched[0][0] > self.budget_seconds
+        ):
+            self.prefetched.popleft()
+        return self.budget - sum(
+            len(page_names) for _, _, page_names in self.prefetched
+        )
+
+    def prefetch(self, pages):
+        # Starts ingesting the top pages of a search that are not ingested yet,
+        # and returns the pages with the job id of the ones being ingested.
+        with self.lock:
+            self.stats["searches"] += 1
+            self.cancel()
+            job_ids = {}
+            candidates = []
+            for page in pages:
+                key = (page["project_name"], page["page_name"])
+                job_id = self.ingestion.get_pending(*key)
+                if job_id:
+                    job_ids[key] = job_id
+                elif not page["status"] and page["views"] >= self.min_views:
+                    candidates.append(page)
+            candidates = candidates[: self.max_pages]
+            budget_left = self.get_budget_left()
+            self.stats["over_budget"] += max(len(candidates) - budget_left, 0)
+            candidates = candidates[: max(budget_left, 0)]
+            for project_name in {page["project_name"] for page in candidates}:
+                page_names = [
+                    page["page_name"]
+                    for page in candidates
+                    if page["project_name"] == project_name
+                ]
+                job = self.ingestion.submit(project_name, page_names, prefetch=True)
+                self.prefetched.append((time.monotonic(), job["job_id"], page_names))
+                for page_name in page_names:
+                    job_ids[(project_name, page_name)] = job["job_id"]
+                self.stats["pages"] += len(page_names)
+        return [
+            dict(page, job_id=job_ids[(page["project_name"], page["page_name"])])
+            if (page["project_name"], page["page_name"]) in job_ids
+            else page
+            for page in pages
+        ]
+
+    def cancel(self):
+        # A later search supersedes older prefetches that have not started yet,
+        # unless a caller has asked for them in the meantime. Cancelled pages
+        # are given back to the budget.
+        now = time.monotonic()
+        for entry in list(self.prefetched):
+            submitted, job_id, _ = entry
+            if now - submitted <= self.supersede_seconds:
+                continue
+            job = self.ingestion.get(job_id, claim=False)
+            if (
+                job["prefetch"]
+                and job["state"] == "queued"
+                and self.ingestion.cancel(job_id)["state"] == "cancelled"
+            ):
+                self.stats["cancelled"] += 1
+                self.prefetched.remove(entry)
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "budget_left": self.get_budget_left()}
+
+
+class RetrievalService:
+    def __init__(
+        self,
+        shard_size=None,
+        directory=None,
+        idle_seconds=30.0,
+        prefetch=False,
+        load_timeout=60.0,
+    ):
+        self.directory = directory
+        # The index loads in the background, so the endpoints that only use
+        # SQLite answer right away and the others wait until it is ready.
+        self.index = None
+        self.index_error = None
+        self.index_ready = threading.Event()
+        self.load_timeout = load_timeout
+        self.load_seconds = None
+        self.lock = threading.Lock()
+        self.batcher = QueryBatcher(self.get_index, self.lock)
+        self.ingestion = IngestionJobs(self.get_index, self.lock)
+        self.prefetcher = Prefetcher(self.ingestion) if prefetch else None
+        self.idle_seconds = idle_seconds
+        self.last_request = time.monotonic()
+        self.stop = threading.Event()
+        with sqlite3.connect("data/rag.db") as connection:
+            migrate_fts_triggers(connection)
+        threading.Thread(
+            target=self.load_index, args=(shard_size,), daemon=True
+        ).start()
+        threading.Thread(
+            target=preload_model, args=("bge-m3", EMBEDDING_KEEP_ALIVE), daemon=True
+        ).start()
+        threading.Thread(
+            target=maintain_fts,
+            args=("data/rag.db", FTS_TABLES, self.is_idle, self.stop),
+            daemon=True,
+        ).start()
+
+    def load_index(self, shard_size):
+        start = time.monotonic()
+        try:
+            self.index = load_faiss(shard_size, self.directory)
+        # Any error is reported through get_readiness and get_index, the
+        # endpoints must not wait for an index that will never be ready.
+        except Exception as error:
+            self.index_error = f"{type(error).__name__}: {error}"
+        self.load_seconds = time.monotonic() - start
+        self.index_ready.set()
+
+    def get_index(self):
+        if not self.index_ready.wait(self.load_timeout):
+            raise RuntimeError("FAISS index is still loading")
+        if self.index_error:
+            raise RuntimeError(f"FAISS index failed to load: {self.index_error}")
+        return self.index
+
+    def get_readiness(self):
+        if not self.index_ready.is_set():
+            faiss = "loading"
+        elif self.index_error:
+            faiss = "failed"
+        else:
+            faiss = "ready"
+        return {
+            "fts": True,
+            "faiss": faiss,
+            "error": self.index_error,
+            "load_seconds": self.load_seconds,
+        }
+
+    def is_idle(self):
+        return time.monotonic() - self.last_request > self.idle_seconds
+
+    def query_faiss(
+        self,
+        prompt,
+        k=5,
+        project_name=None,
+        page_ids=None,
+        min_views=None,
+        diversify=False,
+    ):
+        index = self.get_index()
+        if project_name is None and page_ids is None and min_views is None:
+            return self.batcher.query(prompt, k, diversify)
+        return query_faiss_filtered(
+            index,
+            prompt,
+            k=k,
+            project_name=project_name,
+            page_ids=page_ids,
+            min_views=min_views,
+            diversify=diversify,
+            lock=self.lock,
+        )
+
+    def query_hybrid(self, prompt, k=5, weights=(1.0, 1.0)):
+        return query_hybrid(
+            self.get_index(), prompt, k=k, weights=weights, lock=self.lock
+        )
+
+    def query_fts(self, term, k=5):
+        return query_fts(term, k=k)
+
+    def query_fts_snippets(self, term, k=5, tokens=24, weights=None, highlight=False):
+        return query_fts_snippets(
+            term, k=k, tokens=tokens, weights=weights, highlight=highlight
+        )
+
+    def get_chunk(self, chunk_id):
+        return get_chunk(chunk_id)
+
+    def search_wikipedia_term(self, term, min_views=1_000, k=5):
+        pages = search_wikipedia_term(term, min_views=min_views, k=k)
+        if self.prefetcher:
+            pages = self.prefetcher.prefetch(pages)
+        return pages
+
+    def ingest_wikipedia_page(self, project_name, page_name):
+        return self.ingestion.ingest(project_name, [page_name])[page_name]
+
+    def ingest_wikipedia_pages(self, project_name, page_names):
+        return self.ingestion.ingest(project_name, page_names)
+
+    def submit_ingestion(self, project_name, page_names):
+        return self.ingestion.submit(project_name, page_names)
+
+    def get_ingestion_job(self, job_id, wait=0.0):
+        return self.ingestion.get(job_id, wait)
+
+    def cancel_ingestion_job(self, job_id):
+        return self.ingestion.cancel(job_id)
+
+    def get_prefetch_stats(self):
+        return self.prefetcher.get_stats() if self.prefetcher else None
+
+    def reextract_wikipedia_page(self, project_name, page_name):
+        index = self.get_index()
+        with self.ingestion.ingest_lock, self.lock:
+            return reextract_wikipedia_page(index, project_name, page_name)
+
+    def delete_wikipedia_page(self, project_name, page_name):
+        index = self.get_index()
+        with self.ingestion.ingest_lock, self.lock:
+            return delete_wikipedia_page(index, project_name, page_name)
+
+    def get_cache_stats(self):
+        return RESULT_CACHE.get_stats()
+
+    def save_faiss_shards(self):
+        index = self.get_index()
+        with self.lock:
+            save_faiss_shards(index, self.directory)
+        return True
+
+    def check_faiss_consistency(self):
+        index = self.get_index()
+        with self.lock, sqlite3.connect("data/rag.db") as connection:
+            return check_faiss_consistency(connection, index)
+
+
+ENDPOINTS = [
+    "query_faiss",
+    "query_fts",
+    "query_hybrid",
+    "query_fts_snippets",
+    "get_chunk",
+    "search_wikipedia_term",
+    "ingest_wikipedia_page",
+    "ingest_wikipedia_pages",
+    "submit_ingestion",
+    "get_ingestion_job",
+    "cancel_ingestion_job",
+    "get_prefetch_stats",
+    "reextract_wikipedia_page",
+    "delete_wikipedia_page",
+    "check_faiss_consistency",
+    "save_faiss_shards",
+    "get_cache_stats",
+    "get_readiness",
+]
+
+
+class RetrievalRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        endpoint = self.path.strip("/")
+        if endpoint not in ENDPOINTS:
+            self.reply(404, {"error": f"Unknown endpoint {endpoint}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            arguments = json.loads(self.rfile.read(length) or b"{}")
+            self.server.service.last_request = time.monotonic()
+            result = getattr(self.server.service, endpoint)(**arguments)
+        except (
+            KeyError,
+            TypeError,
+            ValueError,
+            RuntimeError,
+            OSError,
+            sqlite3.Error,
+        ) as error:
+            self.reply(500, {"error": f"{type(error).__name__}: {error}"})
+            return
+        self.reply(200, result)
+
+    def reply(self, status, result):
+        data = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(
+    host="localhost", port=11435, shard_size=None, directory=None, prefetch=False
+):
+    server = ThreadingHTTPServer((host, port), RetrievalRequestHandler)
+    server.service = RetrievalService(shard_size, directory, prefetch=prefetch)
+    print("retrieval service listening on", f"http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    prefetch = "prefetch" in sys.argv[1:]
+    arguments = [argument for argument in sys.argv[1:] if argument != "prefetch"]
+    if len(arguments) >= 4:
+        serve(
+            arguments[0],
+            int(arguments[1]),
+            int(arguments[2]),
+            arguments[3],
+            prefetch=prefetch,
+        )
+    elif len(arguments) >= 2:
+        serve(arguments[0], int(arguments[1]), prefetch=prefetch)
+    else:
+        serve(prefetch=prefetch)
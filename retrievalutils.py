@@ -0,0 +1,131 @@
+import json
+import urllib.request
+from urllib.error import HTTPError, URLError
+
+RETRIEVAL_SERVICE_URL = "http://localhost:11435"
+
+
+def call_retrieval_service(endpoint, arguments):
+    try:
+        with urllib.request.urlopen(
+            f"{RETRIEVAL_SERVICE_URL}/{endpoint}",
+            data=json.dumps(arguments).encode("utf-8"),
+        ) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except HTTPError as e:
+        return json.loads(e.read().decode("utf-8") or "{}") or {"error": e.reason}
+    except (URLError, ConnectionError) as e:
+        # The service is not running or not reachable.
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def query_faiss(
+    prompt, k=5, project_name=None, page_ids=None, min_views=None, diversify=True
+):
+    return call_retrieval_service(
+        "query_faiss",
+        {
+            "prompt": prompt,
+            "k": k,
+            "project_name": project_name,
+            "page_ids": page_ids,
+            "min_views": min_views,
+            "diversify": diversify,
+        },
+    )
+
+
+def query_fts(term, k=5):
+    return call_retrieval_service("query_fts", {"term": term, "k": k})
+
+
+def query_hybrid(prompt, k=5, weights=(1.0, 1.0)):
+    return call_retrieval_service(
+        "query_hybrid", {"prompt": prompt, "k": k, "weights": weights}
+    )
+
+
+def query_fts_snippets(term, k=5, tokens=24, weights=None, highlight=False):
+    return call_retrieval_service(
+        "query_fts_snippets",
+        {
+            "term": term,
+            "k": k,
+            "tokens": tokens,
+            "weights": weights,
+            "highlight": highlight,
+        },
+    )
+
+
+def get_chunk(chunk_id):
+    return call_retrieval_service("get_chunk", {"chunk_id": chunk_id})
+
+
+def search_wikipedia_term(term, min_views=1_000, k=5):
+    return call_retrieval_service(
+        "search_wikipedia_term", {"term": term, "min_views": min_views, "k": k}
+    )
+
+
+def ingest_wikipedia_page(project_name, page_name):
+    return call_retrieval_service(
+        "ingest_wikipedia_page",
+        {"project_name": project_name, "page_name": page_name},
+    )
+
+
+def ingest_wikipedia_pages(project_name, page_names):
+    return call_retrieval_service(
+        "ingest_wikipedia_pages",
+        {"project_name": project_name, "page_names": page_names},
+    )
+
+
+def submit_ingestion(project_name, page_names):
+    return call_retrieval_service(
+        "submit_ingestion",
+        {"project_name": project_name, "page_names": page_names},
+    )
+
+
+def get_ingestion_job(job_id, wait=0.0):
+    return call_retrieval_service("get_ingestion_job", {"job_id": job_id, "wait": wait})
+
+
+def cancel_ingestion_job(job_id):
+    return call_retrieval_service("cancel_ingestion_job", {"job_id": job_id})
+
+
+def get_prefetch_stats():
+    return call_retrieval_service("get_prefetch_stats", {})
+
+
+def reextract_wikipedia_page(project_name, page_name):
+    return call_retrieval_service(
+        "reextract_wikipedia_page",
+        {"project_name": project_name, "page_name": page_name},
+    )
+
+
+def delete_wikipedia_page(project_name, page_name):
+    return call_retrieval_service(
+        "delete_wikipedia_page",
+        {"project_name": project_name, "page_name": page_name},
+    )
+
+
+def check_faiss_consistency():
+    return call_retrieval_service("check_faiss_consistency", {})
+
+
+def save_faiss_shards():
+    return call_retrieval_service("save_faiss_shards", {})
+
+
+def get_cache_stats():
+    return call_retrieval_service("get_cache_stats", {})
+
+
+def get_readiness():
+    return call_retrieval_service("get_readiness", {})
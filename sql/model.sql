@@ -1,6 +1,8 @@
 drop table projects;
 drop table pages;
 drop table pages_fts;
+drop table pages_trigram;
+drop table title_prefixes;
 drop table chunks;
 drop table chunks_fts;
 
@@ -42,19 +44,58 @@ end;
 create trigger if not exists pages_ad
 after delete on pages
 begin
-    insert into pages_fts(pages_fts, rowid)
-    values ('delete', old.id);
+    insert into pages_fts(pages_fts, rowid, name)
+    values ('delete', old.id, old.name);
 end;
 
 create trigger if not exists pages_au
 after update of id, name on pages
 begin
-    insert into pages_fts(pages_fts, rowid)
-    values ('delete', old.id);
+    insert into pages_fts(pages_fts, rowid, name)
+    values ('delete', old.id, old.name);
     insert into pages_fts(rowid, name)
     values (new.id, new.name);
 end;
 
+create virtual table if not exists pages_trigram using fts5(
+    name, 
+    content = 'pages', 
+    content_rowid = 'id',
+    tokenize = 'trigram'
+);
+
+create trigger if not exists pages_trigram_ai
+after insert on pages
+begin
+    insert into pages_trigram(rowid, name)
+    values (new.id, new.name);
+end;
+
+create trigger if not exists pages_trigram_ad
+after delete on pages
+begin
+    insert into pages_trigram(pages_trigram, rowid, name)
+    values ('delete', old.id, old.name);
+end;
+
+create trigger if not exists pages_trigram_au
+after update of id, name on pages
+begin
+    insert into pages_trigram(pages_trigram, rowid, name)
+    values ('delete', old.id, old.name);
+    insert into pages_trigram(rowid, name)
+    values (new.id, new.name);
+end;
+
+create table if not exists title_prefixes (
+    prefix text not null,
+    views integer not null,
+    page_id integer not null,
+    constraint fk_page foreign key (page_id) references pages(id)
+);
+
+create index if not exists title_prefixes_prefix_views on title_prefixes(prefix, views desc);
+
 create table if not exists chunks (
     id integer primary key autoincrement,
     page_id INTEGER,
@@ -84,15 +125,15 @@ end;
 create trigger if not exists chunks_ad
 after delete on chunks
 begin
-    insert into chunks_fts(chunks_fts, rowid)
-    values ('delete', old.id);
+    insert into chunks_fts(chunks_fts, rowid, text)
+    values ('delete', old.id, old.text);
 end;
 
 create trigger if not exists chunks_au
 after update of id, text on chunks
 begin
-    insert into chunks_fts(chunks_fts, rowid)
-    values ('delete', old.id);
+    insert into chunks_fts(chunks_fts, rowid, text)
+    values ('delete', old.id, old.text);
     insert into chunks_fts(rowid, text)
     values (new.id, new.text);
 end;
@@ -1,27 +1,50 @@
 import sys
-from dbutils import (
+from retrievalutils import (
     search_wikipedia_term,
-    ingest_wikipedia_page,
-    load_faiss,
+    submit_ingestion,
+    get_ingestion_job,
     query_faiss,
     query_fts,
+    query_hybrid,
+    query_fts_snippets,
+    get_chunk,
 )
-from llmutils import assemble_messages, chat, chat_stream
-from env import SYSTEM_PROMPT, TOOLS
+from llmutils import CONTEXT_BUDGET, assemble_messages, chat, chat_stream
+from wiki_env import SYSTEM_PROMPT, TOOLS
 
-INDEX = load_faiss()
 TOOLS[0]["handler"] = lambda tool_call: query_faiss(
-    INDEX, tool_call["function"]["arguments"]["prompt"]
+    tool_call["function"]["arguments"]["prompt"],
+    project_name=tool_call["function"]["arguments"].get("project_name"),
+    page_ids=tool_call["function"]["arguments"].get("page_ids"),
+    min_views=tool_call["function"]["arguments"].get("min_views"),
 )
 TOOLS[1]["handler"] = lambda tool_call: search_wikipedia_term(
     tool_call["function"]["arguments"]["term"]
 )
-TOOLS[2]["handler"] = lambda tool_call: ingest_wikipedia_page(
-    INDEX,
+TOOLS[2]["handler"] = lambda tool_call: submit_ingestion(
     tool_call["function"]["arguments"]["project_name"],
-    tool_call["function"]["arguments"]["page_name"],
+    [tool_call["function"]["arguments"]["page_name"]],
 )
-# TOOLS[3]["handler"] = (
+TOOLS[3]["handler"] = lambda tool_call: query_hybrid(
+    tool_call["function"]["arguments"]["prompt"]
+)
+TOOLS[4]["handler"] = lambda tool_call: query_fts_snippets(
+    tool_call["function"]["arguments"]["term"]
+)
+TOOLS[5]["handler"] = lambda tool_call: get_chunk(
+    tool_call["function"]["arguments"]["chunk_id"]
+)
+TOOLS[6]["handler"] = lambda tool_call: submit_ingestion(
+    tool_call["function"]["arguments"]["project_name"],
+    tool_call["function"]["arguments"]["page_names"],
+)
+TOOLS[7]["handler"] = lambda tool_call: get_ingestion_job(
+    tool_call["function"]["arguments"]["job_id"],
+    tool_call["function"]["arguments"].get("wait", 0.0),
+)
+# Waiting for an ingestion job takes up to a minute.
+TOOLS[7]["timeout"] = 90.0
+# TOOLS[8]["handler"] = (
 #     lambda tool_call: query_fts(tool_call["function"]["arguments"]["term"]),
 # )
 
@@ -30,7 +53,7 @@ def run_chat(user_prompt, tools=None):
     system_prompt = SYSTEM_PROMPT if tools else None
     print(user_prompt)
     messages = assemble_messages(system_prompt, user_prompt)
-    for event in chat(messages, tools):
+    for event in chat(messages, tools=tools, task="rag", context_budget=CONTEXT_BUDGET):
         assert event["status"] == 200
         print(event["type"], event["data"])
 
@@ -40,7 +63,9 @@ def run_chat_stream(user_prompt, tools=None):
     print(user_prompt)
     messages = assemble_messages(system_prompt, user_prompt)
     event_type = None
-    for event in chat_stream(messages, tools):
+    for event in chat_stream(
+        messages, tools=tools, task="rag", context_budget=CONTEXT_BUDGET
+    ):
         assert event["status"] == 200
         if event["type"] != event_type:
             print(f"{event['type']} ", end="")
@@ -13,12 +13,14 @@ You must prioritize factual accuracy, source faithfulness, and clear separation
    * specific entities, events, or concepts likely documented on Wikipedia
 2. **If the answer may depend on factual details or scholarly consensus**, you MUST attempt retrieval before answering:
 
-   * First, use `query_faiss` with the user’s question.
+   * First, use `query_hybrid` with the user’s question.
    * If results are weak, ambiguous, or clearly incomplete:
 
      * Use `search_wikipedia_term` to identify relevant Wikipedia pages.
-     * If a relevant page is not yet ingested or has no content indexed, use `ingest_wikipedia_page`.
-     * Then re-run `query_faiss`.
+     * If a relevant page is not yet ingested or has no content indexed, use `ingest_wikipedia_page`, or `ingest_wikipedia_pages` for several pages of one project.
+     * Ingestion runs in the background, use `get_ingestion_job` with the returned job id to wait until its state is `done`.
+     * Pages returned by `search_wikipedia_term` with a `job_id` are already being ingested, wait for that job instead of ingesting them again.
+     * Then re-run `query_hybrid`, or `query_faiss` restricted to the relevant page ids.
 3. You MAY answer without tools only if:
 
    * The question is purely conversational or definitional **and**
@@ -63,6 +65,19 @@ TOOLS = [
                             "type": "string",
                             "description": "Natural language question",
                         },
+                        "project_name": {
+                            "type": "string",
+                            "description": "Optional Wikipedia project name (e.g. en.wikipedia) to restrict the search to",
+                        },
+                        "page_ids": {
+                            "type": "array",
+                            "items": {"type": "integer"},
+                            "description": "Optional page ids (e.g. returned by search_wikipedia_term) to restrict the search to",
+                        },
+                        "min_views": {
+                            "type": "integer",
+                            "description": "Optional minimum number of page views to restrict the search to popular pages",
+                        },
                     },
                     "required": ["prompt"],
                 },
@@ -95,7 +110,7 @@ TOOLS = [
             "type": "function",
             "function": {
                 "name": "ingest_wikipedia_page",
-                "description": "Fetches a Wikipedia page via HTTP, converts it to markdown, splits it into semantic sections, embeds them, and stores them in FAISS and SQLite. Does NOT return page HTML or markdown content.",
+                "description": "Starts a background job that fetches a Wikipedia page via HTTP, converts it to markdown, splits it into semantic sections, embeds them, and stores them in FAISS and SQLite. Returns the job with its job id, use get_ingestion_job to wait for it. Does NOT return page HTML or markdown content.",
                 "parameters": {
                     "type": "object",
                     "properties": {
@@ -113,6 +128,110 @@ TOOLS = [
             },
         },
     },
+    {
+        "description": {
+            "type": "function",
+            "function": {
+                "name": "query_hybrid",
+                "description": "Queries the RAG knowledge base (e.g., ingested Wikipedia markdown sections) using both semantic and lexical retrieval at once, fusing the rankings, to return relevant context chunks for answering a question.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "prompt": {
+                            "type": "string",
+                            "description": "Natural language question",
+                        },
+                    },
+                    "required": ["prompt"],
+                },
+            },
+        },
+    },
+    {
+        "description": {
+            "type": "function",
+            "function": {
+                "name": "query_fts_snippets",
+                "description": "Queries the RAG knowledge base (e.g., ingested Wikipedia markdown sections) using lexical retrieval and returns only short snippets around the matched terms, each with the chunk id of its full text.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "term": {
+                            "type": "string",
+                            "description": "Search terms that must all occur in the chunk",
+                        },
+                    },
+                    "required": ["term"],
+                },
+            },
+        },
+    },
+    {
+        "description": {
+            "type": "function",
+            "function": {
+                "name": "get_chunk",
+                "description": "Returns the full text of a RAG knowledge base chunk by its chunk id, e.g. for a snippet returned by query_fts_snippets.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "chunk_id": {
+                            "type": "integer",
+                            "description": "Chunk id",
+                        },
+                    },
+                    "required": ["chunk_id"],
+                },
+            },
+        },
+    },
+    {
+        "description": {
+            "type": "function",
+            "function": {
+                "name": "ingest_wikipedia_pages",
+                "description": "Starts one background job that ingests several Wikipedia pages of a project like ingest_wikipedia_page, embedding all of them at once. Returns the job with its job id, use get_ingestion_job to wait for it.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "project_name": {
+                            "type": "string",
+                            "description": "Wikipedia project name",
+                        },
+                        "page_names": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Wikipedia page titles",
+                        },
+                    },
+                    "required": ["project_name", "page_names"],
+                },
+            },
+        },
+    },
+    {
+        "description": {
+            "type": "function",
+            "function": {
+                "name": "get_ingestion_job",
+                "description": "Returns the state (queued, running, done or failed) of an ingestion job and the HTTP status of each of its pages once done, optionally waiting for it to finish.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "job_id": {
+                            "type": "string",
+                            "description": "Job id returned by ingest_wikipedia_page or ingest_wikipedia_pages",
+                        },
+                        "wait": {
+                            "type": "number",
+                            "description": "Seconds to wait for the job to finish, at most 60, 0 returns immediately",
+                        },
+                    },
+                    "required": ["job_id"],
+                },
+            },
+        },
+    },
 ]
 """
 {